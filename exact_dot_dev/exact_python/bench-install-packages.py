@@ -0,0 +1,274 @@
+#!/usr/bin/env -S uv run
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#     "pyyaml>=6.0",
+# ]
+# ///
+"""Synthetic benchmark for install-packages.py.
+
+Generates a packages.yaml with hundreds to thousands of packages whose
+sources are stub package managers (shell scripts with configurable latency,
+inventory size and failure rate), then runs install-packages.py against it
+for each worker count. Records wall time, phase times, subprocess count and
+peak RSS for the resolve and install phases, and appends them to a results
+file so regressions show up between commits. Runs offline on plain Linux.
+
+The installer runs on this script's interpreter, so pyyaml is declared here
+as well as in install-packages.py.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from statedir import state_dir
+
+# A stub package manager: stubpm <source> <action> [ids...]
+# State is one "<id> <version>" line per installed package in $STUBPM_STATE/<source>.list
+STUB = r"""#!/bin/sh
+src=$1; act=$2; shift 2
+list="$STUBPM_STATE/$src.list"
+[ "$STUBPM_LATENCY" != 0 ] && sleep "$STUBPM_LATENCY"
+case $act in
+  version) exit 0 ;;
+  list) cat "$list" 2>/dev/null; exit 0 ;;
+  check) grep -q "^$1 " "$list" 2>/dev/null ;;
+  install)
+    for id in "$@"; do
+      case $id in fail-*) echo "stubpm: cannot install $id" >&2; exit 1 ;; esac
+    done
+    for id in "$@"; do echo "$id 1.0.0" >> "$list"; done ;;
+  *) exit 2 ;;
+esac
+"""
+
+
+def current_label() -> str:
+    """Label results with the dotfiles commit this script came from.
+
+    The deployed copy in ~/.dev/python isn't a git checkout, so the commit
+    is looked up in this script's own directory first and then in the
+    chezmoi source dir, never in whatever repo the cwd happens to be.
+    """
+    candidates = [Path(__file__).resolve().parent]
+    if shutil.which("chezmoi"):
+        result = subprocess.run(["chezmoi", "source-path"], capture_output=True, text=True)
+        if result.returncode == 0 and result.stdout.strip():
+            candidates.append(Path(result.stdout.strip()))
+    for directory in candidates:
+        result = subprocess.run(
+            ["git", "-C", str(directory), "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+        )
+        if result.returncode == 0 and result.stdout.strip():
+            return result.stdout.strip()
+    return "unlabeled"
+
+
+def generate(workdir: Path, args, rng: random.Random) -> int:
+    """Write the stub, the manifest and the initial installed state into workdir.
+
+    Returns the exit code a successful run should have (1 when some
+    packages were generated to fail).
+    """
+    bin_dir = workdir / "bin"
+    pm_state = workdir / "pm-state"
+    bin_dir.mkdir()
+    pm_state.mkdir()
+    stub = bin_dir / "stubpm"
+    stub.write_text(STUB)
+    stub.chmod(0o755)
+
+    source_names = [f"s{i}" for i in range(args.sources)]
+    sources = {}
+    for i, name in enumerate(source_names):
+        cfg = {
+            "available": f"stubpm {name} version",
+            "install": f"stubpm {name} install {{pkg}}",
+            "check": f"stubpm {name} check {{pkg}}",
+            "state_files": [str(pm_state / f"{name}.list")],
+        }
+        # Every third source has no inventory, so the per-package check path is exercised too
+        if i % 3 != 2:
+            cfg["check_cmd"] = f"stubpm {name} list"
+            cfg["check_parse"] = {"regex": r"^(?P<name>\S+) (?P<version>\S+)$"}
+        if i % 2 == 0:
+            cfg["batch"] = True
+        if i == 0:
+            cfg["lock"] = "system"
+        sources[name] = cfg
+
+    lists: dict[str, list[str]] = {name: [f"unrelated-{k} 0.1.0" for k in range(args.list_size)] for name in source_names}
+    packages = {}
+    for i in range(args.packages):
+        primary = source_names[i % len(source_names)]
+        secondary = source_names[(i + 1) % len(source_names)]
+        pkg_id = f"fail-p{i}" if rng.random() < args.failure_rate else f"p{i}"
+        packages[f"bench-pkg-{i}"] = {
+            "profiles": ["bench"],
+            "sources": {primary: pkg_id, secondary: pkg_id},
+            "binary": f"bench-bin-{i}",
+        }
+        if not pkg_id.startswith("fail-") and rng.random() < args.installed_ratio:
+            lists[primary].append(f"{pkg_id} 1.0.0")
+    for name, lines in lists.items():
+        rng.shuffle(lines)
+        (pm_state / f"{name}.list").write_text("".join(f"{line}\n" for line in lines))
+
+    manifest = {
+        "sources": sources,
+        "profiles": {"bench": {"source_preference": {os_name: source_names for os_name in ("linux", "darwin")}}},
+        "packages": packages,
+    }
+    # JSON is valid YAML, so no yaml dependency is needed here
+    (workdir / "packages.yaml").write_text(json.dumps(manifest, indent=1))
+    return 1 if any(next(iter(cfg["sources"].values())).startswith("fail-") for cfg in packages.values()) else 0
+
+
+def run_once(installer: Path, template: Path, workers: int, expected_exit: int, args) -> dict:
+    """Run install-packages.py on a fresh copy of the generated tree and measure it.
+
+    Exits the benchmark if the run didn't complete normally (wrong exit code
+    or no trace), so a broken run never ends up in the results as a baseline.
+    """
+    with tempfile.TemporaryDirectory(prefix="bench-run-") as tmp:
+        workdir = Path(tmp) / "tree"
+        shutil.copytree(template, workdir, symlinks=True)
+        trace = workdir / "trace.json"
+        env = dict(
+            os.environ,
+            PATH=f"{workdir / 'bin'}{os.pathsep}{os.environ.get('PATH', '')}",
+            STUBPM_STATE=str(workdir / "pm-state"),
+            STUBPM_LATENCY=str(args.latency),
+            XDG_STATE_HOME=str(workdir / "xdg-state"),
+        )
+        cmd = [
+            sys.executable, str(installer),
+            "--profile", "bench", "--manifest", str(workdir / "packages.yaml"),
+            "--no-cache", "--full", "--workers", str(workers), "--jobs", str(args.jobs),
+            "--trace", str(trace),
+        ]
+        stderr_path = Path(tmp) / "stderr.log"
+        start = time.perf_counter()
+        with open(stderr_path, "wb") as stderr:
+            proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=stderr)
+            if hasattr(os, "wait4"):
+                _, status, rusage = os.wait4(proc.pid, 0)
+                exit_code = os.waitstatus_to_exitcode(status)
+                # ru_maxrss is KiB on Linux
+                peak_rss_mb = round(rusage.ru_maxrss / 1024, 1)
+            else:
+                exit_code, peak_rss_mb = proc.wait(), None
+        wall = time.perf_counter() - start
+
+        try:
+            events = json.loads(trace.read_text())["traceEvents"]
+        except (OSError, ValueError, KeyError):
+            events = None
+        if exit_code != expected_exit or events is None:
+            problem = "wrote no trace" if events is None else f"exited {exit_code} (expected {expected_exit})"
+            print(f"\n❌ {installer.name} {problem}; no results recorded", file=sys.stderr)
+            print(stderr_path.read_text(errors="replace")[-2000:], file=sys.stderr)
+            sys.exit(1)
+        phases = {e["name"]: e["dur"] / 1e6 for e in events if e.get("cat") == "phase"}
+        return {
+            "wall_s": round(wall, 3),
+            "resolve_s": round(phases.get("fetch inventories", 0) + phases.get("resolve", 0), 3),
+            "install_s": round(phases.get("install", 0), 3),
+            "subprocesses": sum(1 for e in events if e.get("cat") == "command"),
+            "peak_rss_mb": peak_rss_mb,
+            "exit_code": exit_code,
+        }
+
+
+def load_previous(path: Path, label: str) -> dict[str, dict]:
+    """Return the most recent result per scenario from a different label."""
+    previous: dict[str, dict] = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("label") != label:
+                    previous[json.dumps(record["scenario"], sort_keys=True)] = record
+    except OSError:
+        pass
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark install-packages.py against stub package managers")
+    parser.add_argument("--packages", type=str, default="200,1000", help="Comma-separated package counts")
+    parser.add_argument("--workers", type=str, default="1,4,16", help="Comma-separated resolve worker counts")
+    parser.add_argument("--jobs", type=int, default=4, help="Install concurrency passed to install-packages")
+    parser.add_argument("--sources", type=int, default=6, help="Number of stub sources")
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds each stub call sleeps")
+    parser.add_argument("--list-size", type=int, default=500, help="Unrelated entries in each source inventory")
+    parser.add_argument("--installed-ratio", type=float, default=0.7, help="Fraction of packages pre-installed")
+    parser.add_argument("--failure-rate", type=float, default=0.02, help="Fraction of packages that fail to install")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scenario (best is kept)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", type=str, help="Label for stored results (default: current git commit)")
+    parser.add_argument(
+        "--results", type=Path, default=state_dir("install-packages") / "bench.jsonl",
+        help="JSONL file results are appended to",
+    )
+    parser.add_argument(
+        "--installer", type=Path, default=Path(__file__).with_name("install-packages.py"),
+        help="install-packages.py to benchmark",
+    )
+    args = parser.parse_args()
+
+    if sys.platform == "win32":
+        print("The stub package managers are shell scripts; run this on Linux or macOS", file=sys.stderr)
+        sys.exit(1)
+
+    label = args.label or current_label()
+    previous = load_previous(args.results, label)
+    records = []
+
+    print(f"🏁 Benchmarking {args.installer.name} [{label}]\n")
+    print(f"  {'packages':>8} {'workers':>7} {'wall':>8} {'resolve':>8} {'install':>8} {'procs':>6} {'rss':>7}  vs last")
+    for count in [int(n) for n in args.packages.split(",")]:
+        with tempfile.TemporaryDirectory(prefix="bench-tree-") as tmp:
+            template = Path(tmp)
+            generate_args = argparse.Namespace(**{**vars(args), "packages": count})
+            expected_exit = generate(template, generate_args, random.Random(args.seed))
+            for workers in [int(n) for n in args.workers.split(",")]:
+                runs = [run_once(args.installer, template, workers, expected_exit, args) for _ in range(args.repeat)]
+                best = min(runs, key=lambda r: r["wall_s"])
+                scenario = {
+                    "packages": count, "workers": workers, "jobs": args.jobs, "sources": args.sources,
+                    "latency": args.latency, "list_size": args.list_size,
+                    "installed_ratio": args.installed_ratio, "failure_rate": args.failure_rate,
+                }
+                record = {"label": label, "time": time.time(), "scenario": scenario, **best}
+                records.append(record)
+
+                last = previous.get(json.dumps(scenario, sort_keys=True))
+                delta = f"{(best['wall_s'] / last['wall_s'] - 1) * 100:+.0f}% ({last['label']})" if last else "-"
+                print(
+                    f"  {count:>8} {workers:>7} {best['wall_s']:>7.2f}s {best['resolve_s']:>7.2f}s "
+                    f"{best['install_s']:>7.2f}s {best['subprocesses']:>6} "
+                    + (f"{best['peak_rss_mb']:>5.0f}MB" if best["peak_rss_mb"] is not None else f"{'-':>7}")
+                    + f"  {delta}"
+                )
+
+    args.results.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.results, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    print(f"\n📈 Results appended to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
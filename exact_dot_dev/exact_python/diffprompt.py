@@ -0,0 +1,185 @@
+"""Condense a git diff into a budgeted LLM prompt.
+
+Shared by step.py (commit messages) and gn.py (branch names), which import
+it from this directory; gd.py reuses its per-file section parsing. Lockfiles, generated or minified files and binaries
+are reduced to one-line stubs, large hunks are cut down to their header and
+first lines, and files are ranked by churn so that when the token budget
+runs out it is the smallest changes that are left out. The file listing at
+the top is charged against the same budget: it takes at most a quarter of
+it, most-changed files first, and summarises the rest as a count.
+"""
+
+import fnmatch
+import re
+from typing import NamedTuple
+
+DEFAULT_BUDGET = 12_000  # tokens
+HUNK_MAX_LINES = 60  # hunks longer than this are truncated...
+HUNK_KEEP_LINES = 15  # ...to their header plus this many lines
+MINIFIED_LINE = 1000  # a line this long means minified or generated content
+LISTING_SHARE = 4  # the file listings get at most 1/LISTING_SHARE of the budget
+
+LOCK_FILES = {
+    "package-lock.json", "npm-shrinkwrap.json", "yarn.lock", "pnpm-lock.yaml", "bun.lockb",
+    "Cargo.lock", "poetry.lock", "uv.lock", "Pipfile.lock", "Gemfile.lock", "composer.lock",
+    "go.sum", "flake.lock", "packages.lock.json", "mix.lock", "pubspec.lock",
+}
+GENERATED_PATTERNS = [
+    "*.min.js", "*.min.css", "*.map", "*.pb.go", "*_pb2.py", "*_pb2.pyi",
+    "*.generated.*", "*.g.cs", "*.Designer.cs", "*.snap", "*.svg",
+]
+
+
+class FileDiff(NamedTuple):
+    path: str
+    status: str  # A, D, R or M
+    added: int
+    deleted: int
+    binary: bool
+    text: str
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+def section_path(section: str) -> str:
+    """Return the (new) path a `diff --git` section is about."""
+    for prefix in ("+++ b/", "--- a/", "rename to ", "copy to "):
+        m = re.search(rf"^{re.escape(prefix)}(.*)$", section, re.MULTILINE)
+        if m:
+            return m.group(1).rstrip("\t")
+    # No content lines (binary, mode-only): "diff --git a/<p> b/<p>"
+    header = section.split("\n", 1)[0][len("diff --git a/"):]
+    return header[:(len(header) - 3) // 2]
+
+
+def churn(section: str) -> tuple[int, int] | None:
+    """Count added and deleted lines in a section, like --numstat (None for binary files)."""
+    if re.search(r"^(Binary files |GIT binary patch)", section, re.MULTILINE):
+        return None
+    added = deleted = 0
+    in_hunk = False
+    for line in section.split("\n"):
+        if line.startswith("@@"):
+            in_hunk = True
+        elif in_hunk and line.startswith("+"):
+            added += 1
+        elif in_hunk and line.startswith("-"):
+            deleted += 1
+    return added, deleted
+
+
+def parse_diff(diff: str) -> list[FileDiff]:
+    """Split a unified git diff into per-file sections."""
+    files = []
+    for section in re.split(r"^(?=diff --git )", diff, flags=re.MULTILINE):
+        if not section.startswith("diff --git "):
+            continue
+        head = section.split("\n@@", 1)[0]
+        if "\nnew file mode" in head:
+            status = "A"
+        elif "\ndeleted file mode" in head:
+            status = "D"
+        elif "\nrename to " in head:
+            status = "R"
+        else:
+            status = "M"
+        stats = churn(section)
+        added, deleted = stats or (0, 0)
+        files.append(FileDiff(section_path(section), status, added, deleted, stats is None, section))
+    return files
+
+
+def stub_reason(f: FileDiff) -> str | None:
+    """Why a file's content should be left out of the prompt, if it should."""
+    name = f.path.rsplit("/", 1)[-1]
+    if f.binary:
+        return "binary file"
+    if name in LOCK_FILES or name.endswith(".lock"):
+        return "lockfile"
+    if any(fnmatch.fnmatch(name, pattern) for pattern in GENERATED_PATTERNS):
+        return "generated file"
+    if any(len(line) > MINIFIED_LINE for line in f.text.split("\n")):
+        return "minified or generated content"
+    return None
+
+
+def truncate_hunks(text: str) -> str:
+    """Cut hunks longer than HUNK_MAX_LINES down to their header and first lines."""
+    out: list[str] = []
+    hunk: list[str] = []
+
+    def flush():
+        if len(hunk) > HUNK_MAX_LINES + 1:
+            out.extend(hunk[:HUNK_KEEP_LINES + 1])
+            out.append(f"[... {len(hunk) - HUNK_KEEP_LINES - 1} more lines in this hunk]")
+        else:
+            out.extend(hunk)
+        hunk.clear()
+
+    for line in text.split("\n"):
+        if line.startswith("@@"):
+            flush()
+            hunk.append(line)
+        elif hunk:
+            hunk.append(line)
+        else:
+            out.append(line)
+    flush()
+    return "\n".join(out)
+
+
+def cap_lines(lines: list[str], budget: int) -> list[str]:
+    """Keep leading lines within `budget` tokens and summarise the rest as a count."""
+    kept: list[str] = []
+    used = 0
+    for i, line in enumerate(lines):
+        used += estimate_tokens(line)
+        if used > budget:
+            return kept + [f"  ... and {len(lines) - i} more"]
+        kept.append(line)
+    return kept
+
+
+def build_diff_prompt(diff: str, budget: int = DEFAULT_BUDGET, untracked: list[str] | None = None) -> str:
+    """Condense `diff` into at most about `budget` tokens.
+
+    New files appear once, through the diff (their content is not added
+    again separately). `untracked` paths that aren't part of the diff are
+    listed by name only.
+    """
+    files = sorted(parse_diff(diff), key=lambda f: -(f.added + f.deleted))
+    diffed = {f.path for f in files}
+    untracked = [path for path in untracked or [] if path not in diffed]
+
+    listing_budget = budget // LISTING_SHARE
+    listing = [f"Changed files ({len(files)}):"] + cap_lines([
+        f"  {f.status} {f.path}" + (" (binary)" if f.binary else f" (+{f.added} -{f.deleted})") for f in files
+    ], listing_budget)
+    if untracked:
+        listing.append(f"Untracked files ({len(untracked)}):")
+        listing.extend(cap_lines(
+            [f"  ? {path}" for path in untracked], listing_budget - estimate_tokens("\n".join(listing)),
+        ))
+    parts = ["\n".join(listing)]
+    remaining = budget - estimate_tokens(parts[0])
+
+    omitted = 0
+    for f in files:
+        reason = stub_reason(f)
+        if reason:
+            header = f.text.split("\n", 1)[0]
+            body = f"{header}\n[{reason} changed, content omitted]"
+        else:
+            body = truncate_hunks(f.text)
+        cost = estimate_tokens(body)
+        if cost > remaining:
+            omitted += 1
+            continue
+        parts.append(body)
+        remaining -= cost
+    if omitted:
+        parts.append(f"[Diffs of {omitted} more file(s) omitted to fit the prompt budget]")
+    return "\n".join(parts)
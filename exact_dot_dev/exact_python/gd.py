@@ -3,46 +3,108 @@
 # requires-python = ">=3.11"
 # dependencies = []
 # ///
-"""Interactive git diff viewer using fzf and delta."""
+"""Interactive git diff viewer using fzf and delta.
 
+The whole diff is produced by one git invocation and split per file into a
+temp dir; previews are served from there, each file rendered through delta
+once per preview width instead of re-diffing on every cursor move.
+"""
+
+import argparse
+import os
+import re
 import shutil
 import subprocess
 import sys
+import tempfile
+from pathlib import Path
+
+from diffprompt import churn, section_path
+
+
+def split_diff(diff: bytes, cache: Path) -> list[tuple[int, str, tuple[int, int] | None]]:
+    """Write each file's section of a diff to cache/<n>.diff; return (n, path, churn)."""
+    files = []
+    for section in re.split(rb"^(?=diff --git )", diff, flags=re.MULTILINE):
+        if not section.startswith(b"diff --git "):
+            continue
+        n = len(files)
+        (cache / f"{n}.diff").write_bytes(section)
+        text = section.decode("utf-8", errors="replace")
+        files.append((n, section_path(text), churn(text)))
+    return files
+
+
+def show_preview(cache: Path, n: str):
+    """Print a file's diff, rendering it through delta only the first time at this width."""
+    width = os.environ.get("FZF_PREVIEW_COLUMNS", "")
+    raw = cache / f"{n}.diff"
+    rendered = cache / f"{n}.{width}.out"
+    if not rendered.exists():
+        delta = shutil.which("delta")
+        if delta:
+            with open(raw, "rb") as f:
+                result = subprocess.run(
+                    [delta, f"--width={width}"] if width else [delta], stdin=f, capture_output=True,
+                )
+            output = result.stdout if result.returncode == 0 else raw.read_bytes()
+        else:
+            output = raw.read_bytes()
+        tmp = rendered.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_bytes(output)
+        os.replace(tmp, rendered)
+    sys.stdout.buffer.write(rendered.read_bytes())
 
 
 def main():
-    extra_args = sys.argv[1:] if len(sys.argv) > 1 else []
+    parser = argparse.ArgumentParser(
+        description="Browse a git diff file by file (other arguments are passed to git diff)",
+        allow_abbrev=False,
+    )
+    parser.add_argument("--churn", action="store_true", help="List the most changed files first")
+    parser.add_argument("--preview", nargs=2, metavar=("CACHE", "N"), help=argparse.SUPPRESS)
+    args, extra_args = parser.parse_known_args()
+
+    if args.preview:
+        show_preview(Path(args.preview[0]), args.preview[1])
+        return
 
     fzf = shutil.which("fzf")
     if not fzf:
         print("fzf not found", file=sys.stderr)
         sys.exit(1)
 
-    diff_cmd = ["git", "diff", "--name-only"] + extra_args
-    result = subprocess.run(diff_cmd, capture_output=True, text=True)
+    diff_cmd = ["git", "-c", "core.quotePath=false", "diff", "--color=never"] + extra_args
+    result = subprocess.run(diff_cmd, stdout=subprocess.PIPE)
 
     if not result.stdout.strip():
         print("No changes found")
         sys.exit(0)
 
-    delta = shutil.which("delta")
-    if extra_args:
-        preview = f"git diff {' '.join(extra_args)} -- {{}}"
-    else:
-        preview = "git diff {}"
-
-    if delta:
-        preview += " | delta --width=$FZF_PREVIEW_COLUMNS"
-
-    fzf_args = [
-        fzf,
-        "--preview", preview,
-        "--preview-window=up,70%",
-        "--bind", "ctrl-j:preview-down,ctrl-k:preview-up,ctrl-u:preview-half-page-up,ctrl-i:preview-half-page-down",
-        "--height=100%",
-    ]
+    cache = Path(tempfile.mkdtemp(prefix="gd-"))
+    try:
+        files = split_diff(result.stdout, cache)
+        if args.churn:
+            files.sort(key=lambda f: -sum(f[2] or (0, 0)))
 
-    subprocess.run(fzf_args, input=result.stdout, text=True)
+        fzf_args = [
+            fzf,
+            "--delimiter=\t",
+            "--with-nth=2..",
+            "--preview", f'"{sys.executable}" "{os.path.abspath(__file__)}" --preview "{cache}" {{1}}',
+            "--preview-window=up,70%",
+            "--bind", "ctrl-j:preview-down,ctrl-k:preview-up,ctrl-u:preview-half-page-up,ctrl-i:preview-half-page-down",
+            "--height=100%",
+        ]
+        lines = "".join(
+            f"{n}\t{path}\t" + (f"+{stats[0]} -{stats[1]}" if stats else "binary") + "\n"
+            for n, path, stats in files
+        )
+        selected = subprocess.run(fzf_args, input=lines, text=True, stdout=subprocess.PIPE)
+        for line in selected.stdout.splitlines():
+            print(line.split("\t")[1])
+    finally:
+        shutil.rmtree(cache, ignore_errors=True)
 
 
 if __name__ == "__main__":
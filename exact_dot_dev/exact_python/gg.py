@@ -3,14 +3,43 @@
 # requires-python = ">=3.11"
 # dependencies = []
 # ///
-"""Find and select a git repository using fzf. Prints selected path to stdout."""
+"""Find and select a git repository using fzf. Prints selected path to stdout.
 
+Repos are served from an on-disk index so fzf opens without walking the
+source dirs (slow across the WSL /mnt mounts). Each run starts a detached
+refresh that re-lists only directories whose mtime changed and updates the
+index for the next run. Without a usable index (first run, --rescan), fzf
+opens straight away and repos are streamed into it as the walk finds them.
+Previews are cached per repo until its HEAD, index or refs change, and the
+top candidates' previews are rendered in the background while fzf opens.
+Repos are listed most frecently selected first.
+"""
+
+import argparse
+import hashlib
+import itertools
 import os
+import queue
 import shutil
 import subprocess
 import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from statedir import read_json, spawn_detached, state_dir, write_json
+
+MAX_DEPTH = 3
+INDEX_VERSION = 1
+REFRESH_INTERVAL = 30  # seconds between background refreshes
+PREVIEW_TTL = 300  # seconds a cached preview is trusted; unstaged edits don't touch any key file
+PREVIEW_WARM = 20  # candidates whose previews are rendered ahead of time
+FRECENCY_HALF_LIFE = 7 * 24 * 3600  # seconds for a selection's weight to halve
+FRECENCY_MAX = 200  # repos remembered; the lowest scores are dropped beyond this
+FRECENCY_TOP = 10  # top repos a query can jump to even if other repos match too
+
 
 def find_src_dirs():
     """Find source directories to search for repos."""
@@ -29,23 +58,143 @@ def find_src_dirs():
     return [d for d in candidates if d.is_dir()]
 
 
-def find_repos(src_dirs):
-    """Find git repositories up to depth 3."""
-    repos = set()
-    for src_dir in src_dirs:
-        for root, dirs, files in os.walk(str(src_dir)):
-            depth = root.replace(str(src_dir), "").count(os.sep)
-            if depth >= 3:
-                dirs.clear()
-                continue
-            if ".git" in dirs or ".git" in files:
-                repos.add(root)
-                dirs.clear()
-    return sorted(repos)
+def scan_dir(path, depth, dirs, seen, previous):
+    """Visit one directory of the walk and yield the repos under it, reusing
+    each directory's previous listing if its mtime hasn't changed.
+
+    A directory's mtime changes whenever an entry is added, removed or
+    renamed in it, which is all that can turn a child into (or out of) a repo,
+    so unchanged directories only cost a stat. Visited directories are
+    recorded in `dirs` as [mtime_ns, is_repo, child dir names]; `seen` holds
+    the shallowest depth each was reached at, since source dirs can nest.
+    """
+    if depth >= MAX_DEPTH or seen.get(path, MAX_DEPTH) <= depth:
+        return
+    seen[path] = depth
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return
+    entry = previous.get(path)
+    if not entry or entry[0] != mtime:
+        is_repo, children = False, []
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    if e.name == ".git":
+                        is_repo = True
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            children.append(e.name)
+                    except OSError:
+                        continue
+        except OSError:
+            return
+        entry = [mtime, is_repo, [] if is_repo else sorted(children)]
+    dirs[path] = entry
+    if entry[1]:
+        yield path
+        return
+    for name in entry[2]:
+        yield from scan_dir(os.path.join(path, name), depth + 1, dirs, seen, previous)
+
+
+def read_index(index_path):
+    """Load the repo index, or None if it is missing or from another version."""
+    index = read_json(index_path)
+    return index if isinstance(index, dict) and index.get("version") == INDEX_VERSION else None
+
+
+def stream_repos(index_path, src_dirs, previous=None):
+    """Walk src_dirs to depth 3, yielding (repo, branch) as repos are found.
+
+    The walk is incremental against a previous index. Branches are looked up
+    on a thread pool while the walk carries on, and repos are yielded in walk
+    order as soon as their branch is known. The new index is saved once the
+    walk completes.
+    """
+    previous_dirs = previous["dirs"] if previous else {}
+    dirs, seen, branches = {}, {}, {}
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        for src_dir in src_dirs:
+            for repo in scan_dir(str(src_dir), 0, dirs, seen, previous_dirs):
+                pending.append((repo, pool.submit(get_branch, repo)))
+                while pending and pending[0][1].done():
+                    repo, future = pending.popleft()
+                    branches[repo] = future.result()
+                    yield repo, branches[repo]
+        for repo, future in pending:
+            branches[repo] = future.result()
+            yield repo, branches[repo]
+    write_json(index_path, {
+        "version": INDEX_VERSION,
+        "roots": [str(d) for d in src_dirs],
+        "refreshed": time.time(),
+        "dirs": dirs,
+        "repos": dict(sorted(branches.items())),
+    })
+
+
+def refresh_index(index_path, src_dirs):
+    """Rescan changed directories and refresh every repo's branch (the background job)."""
+    # Branches change without touching any directory mtime we track, so recheck them all
+    # (HEAD reads are cheap; git only runs for unusual layouts)
+    for _ in stream_repos(index_path, src_dirs, read_index(index_path)):
+        pass
+
+
+def spawn_refresh():
+    """Start a detached `gg.py --refresh` that outlives this process."""
+    spawn_detached([sys.executable, __file__, "--refresh"])
+
+
+def find_git_dir(repo_path):
+    """Return a repo's git dir, following `.git` files (worktrees, submodules), or None."""
+    git_dir = os.path.join(repo_path, ".git")
+    if not os.path.isfile(git_dir):
+        return git_dir
+    try:
+        with open(git_dir) as f:
+            line = f.readline().strip()
+    except OSError:
+        return None
+    if not line.startswith("gitdir:"):
+        return None
+    return os.path.join(repo_path, line[len("gitdir:"):].strip())
+
+
+def read_head(repo_path):
+    """Read a repo's current branch straight from its HEAD file.
+
+    Handles `.git` files pointing elsewhere (worktrees, submodules) and
+    detached HEADs. Returns None when the layout is unusual (no readable
+    HEAD, reftable refs) so the caller can ask git instead.
+    """
+    git_dir = find_git_dir(repo_path)
+    if not git_dir:
+        return None
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as f:
+            head = f.readline().strip()
+    except OSError:
+        return None
+    if head.startswith("ref: "):
+        ref = head[len("ref: "):]
+        # Reftable repos keep a placeholder HEAD; only git can resolve those
+        if ref == "refs/heads/.invalid":
+            return None
+        return ref.removeprefix("refs/heads/")
+    if len(head) in (40, 64) and all(c in "0123456789abcdef" for c in head):
+        return "detached"
+    return None
 
 
 def get_branch(repo_path):
-    """Get the current branch of a repo."""
+    """Get the current branch of a repo, asking git only when HEAD can't be read directly."""
+    branch = read_head(repo_path)
+    if branch:
+        return branch
     try:
         result = subprocess.run(
             ["git", "-C", repo_path, "branch", "--show-current"],
@@ -56,62 +205,233 @@ def get_branch(repo_path):
         return "unknown"
 
 
+def preview_key(repo_path):
+    """Return what a repo's preview depends on: its branch and the mtimes of
+    HEAD, the index and the refs, or None if the git dir can't be found."""
+    git_dir = find_git_dir(repo_path)
+    if not git_dir:
+        return None
+    # Worktrees keep HEAD and index to themselves but share refs with the main repo
+    common_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, "commondir")) as f:
+            common_dir = os.path.join(git_dir, f.readline().strip())
+    except OSError:
+        pass
+    branch = read_head(repo_path)
+    paths = [
+        os.path.join(git_dir, "HEAD"), os.path.join(git_dir, "index"),
+        os.path.join(common_dir, "packed-refs"), os.path.join(common_dir, "refs", "heads"),
+    ]
+    if branch and branch != "detached":
+        paths.append(os.path.join(common_dir, "refs", "heads", branch))
+    key = [branch]
+    for path in paths:
+        try:
+            key.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            key.append(None)
+    return key
+
+
+def render_preview(repo_path):
+    """Render the status + log preview for a repo."""
+    status = subprocess.run(
+        ["git", "-C", repo_path, "status", "-sb"], capture_output=True, text=True, timeout=30,
+    )
+    log = subprocess.run(
+        ["git", "-C", repo_path, "log", "--oneline", "--graph", "--decorate", "-10", "--color"],
+        capture_output=True, text=True, timeout=30,
+    )
+    return f"── status ──\n{status.stdout}{status.stderr}\n── log ──\n{log.stdout}"
+
+
+def get_preview(repo_path, cache_dir):
+    """Return a repo's preview, rendering it only if its cached copy is stale."""
+    key = preview_key(repo_path)
+    path = cache_dir / f"{hashlib.sha1(repo_path.encode()).hexdigest()}.json"
+    cached = read_json(path)
+    if (
+        key is not None and isinstance(cached, dict) and cached.get("key") == key
+        and time.time() - cached.get("time", 0) < PREVIEW_TTL
+    ):
+        return cached["text"]
+    try:
+        text = render_preview(repo_path)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return f"preview failed: {e}"
+    if key is not None:
+        write_json(path, {"key": key, "time": time.time(), "text": text})
+    return text
+
+
+def start_preview_warmers(cache_dir, workers=4):
+    """Start daemon threads rendering previews for repos put on the returned queue."""
+    warm = queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                get_preview(warm.get(), cache_dir)
+            except Exception:
+                pass
+
+    for _ in range(workers):
+        threading.Thread(target=worker, daemon=True).start()
+    return warm
+
+
+def load_frecency(path):
+    """Return {repo: score} aged to now.
+
+    The store keeps every score relative to one shared timestamp, so aging
+    is a single multiplication and a selection rewrites one small file.
+    """
+    data = read_json(path)
+    try:
+        decay = 0.5 ** ((time.time() - data["time"]) / FRECENCY_HALF_LIFE)
+        return {repo: score * decay for repo, score in data["scores"].items()}
+    except (TypeError, KeyError, AttributeError):
+        return {}
+
+
+def record_selection(path, repo):
+    """Bump a repo's frecency, forgetting the lowest-scored repos beyond FRECENCY_MAX."""
+    scores = load_frecency(path)
+    scores[repo] = scores.get(repo, 0) + 1
+    if len(scores) > FRECENCY_MAX:
+        scores = dict(sorted(scores.items(), key=lambda item: -item[1])[:FRECENCY_MAX])
+    write_json(path, {"time": time.time(), "scores": {r: round(score, 4) for r, score in scores.items()}})
+
+
+def single_match(query, repos):
+    """Return the one repo whose path contains query (case-insensitively), if exactly one does."""
+    filtered = [r for r in repos if query.lower() in r.lower()]
+    return filtered[0] if len(filtered) == 1 else None
+
+
 def main():
-    query = " ".join(sys.argv[1:]) if len(sys.argv) > 1 else ""
+    parser = argparse.ArgumentParser(description="Select a git repository with fzf")
+    parser.add_argument("query", nargs="*", help="Initial fzf query")
+    parser.add_argument("--rescan", action="store_true", help="Walk every source directory instead of using the index")
+    parser.add_argument("--refresh", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--preview", metavar="REPO", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    query = " ".join(args.query)
+
+    preview_dir = state_dir("gg") / "previews"
+    if args.preview:
+        print(get_preview(args.preview, preview_dir), end="")
+        return
 
     src_dirs = find_src_dirs()
     if not src_dirs:
         print("No source directories found", file=sys.stderr)
         sys.exit(1)
 
-    repos = find_repos(src_dirs)
-    if not repos:
-        print("No git repositories found", file=sys.stderr)
-        sys.exit(1)
+    index_path = state_dir("gg") / "repos.json"
+    if args.refresh:
+        refresh_index(index_path, src_dirs)
+        return
 
     fzf = shutil.which("fzf")
     if not fzf:
         print("fzf not found", file=sys.stderr)
         sys.exit(1)
 
-    # If only one match for the query, go directly
-    if query:
-        filtered = [r for r in repos if query.lower() in r.lower()]
-        if len(filtered) == 1:
-            print(filtered[0])
-            return
-
-    # Build display with branch info
-    display_lines = []
-    for repo in repos:
-        branch = get_branch(repo)
-        display_lines.append(f"{repo}\t({branch})")
+    frecency_path = state_dir("gg") / "frecency.json"
+    scores = load_frecency(frecency_path)
+    frecent = sorted(scores, key=scores.get, reverse=True)
 
     fzf_args = [
         fzf,
         "--prompt=repo> ",
+        # Keep the frecency order among equally good matches
+        "--tiebreak=index",
         "--delimiter=\t",
         "--with-nth=1..",
-        "--preview", (
-            "echo '── status ──' && git -C {1} status -sb && echo '' && "
-            "echo '── log ──' && git -C {1} log --oneline --graph --decorate -10 --color 2>/dev/null"
-        ),
+        # Straight to this interpreter: the preview runs on every cursor move
+        "--preview", f'"{sys.executable}" "{os.path.abspath(__file__)}" --preview {{1}}',
         "--preview-window=right:50%",
     ]
     if query:
         fzf_args.extend(["--query", query])
 
-    result = subprocess.run(
-        fzf_args,
-        input="\n".join(display_lines),
-        text=True,
-        stdout=subprocess.PIPE,
-    )
-    if result.returncode != 0 or not result.stdout.strip():
-        sys.exit(1)
+    index = read_index(index_path)
+    streaming = args.rescan or not index or index.get("roots") != [str(d) for d in src_dirs]
+    if not streaming:
+        repos = index["repos"]
+        if not repos:
+            print("No git repositories found", file=sys.stderr)
+            sys.exit(1)
+        if time.time() - index.get("refreshed", 0) > REFRESH_INTERVAL:
+            spawn_refresh()
+        frecent = [r for r in frecent if r in repos]
+        top = frecent[:FRECENCY_TOP]
+        # Frecent repos first, the rest in index order
+        entries = [(r, repos[r]) for r in frecent] + [(r, b) for r, b in repos.items() if r not in scores]
+    else:
+        # No usable index: open fzf now and feed it while walking. fzf decides
+        # the full-list single-match shortcut itself once the input is complete.
+        # Frecent repos that no longer exist are dropped as they're streamed,
+        # so fzf isn't held up statting all of them first.
+        top = [r for r in frecent[:FRECENCY_TOP] if os.path.isdir(r)]
+        walk = stream_repos(index_path, src_dirs, None if args.rescan else index)
+        entries = itertools.chain(
+            ((r, get_branch(r)) for r in frecent if os.path.isdir(r)),
+            ((r, b) for r, b in walk if r not in scores),
+        )
+        fzf_args.append("--exit-0")
+        if query:
+            fzf_args.append("--select-1")
 
-    selected = result.stdout.strip().split("\t")[0]
-    print(selected)
+    # If only one match for the query among the top repos, or overall, go directly
+    if query:
+        selected = single_match(query, top) or (not streaming and single_match(query, repos))
+        if selected:
+            record_selection(frecency_path, selected)
+            print(selected)
+            return
+
+    proc = subprocess.Popen(fzf_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    warm = start_preview_warmers(preview_dir)
+    fed = threading.Event()
+
+    def feed():
+        """Write entries to fzf; runs on a thread so a pick is acted on while the walk goes on."""
+        try:
+            for n, (repo, branch) in enumerate(entries):
+                proc.stdin.write(f"{repo}\t({branch})\n")
+                proc.stdin.flush()
+                if n < PREVIEW_WARM:
+                    warm.put(repo)
+            fed.set()
+        except OSError:
+            # fzf exited before reading everything (BrokenPipeError, or EINVAL on Windows)
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    stdout = proc.stdout.read()
+    returncode = proc.wait()
+    if streaming and not fed.is_set():
+        # fzf finished before the walk did; complete the index in the background
+        spawn_refresh()
+
+    selected = stdout.strip().split("\t")[0] if returncode == 0 and stdout.strip() else None
+    if selected:
+        record_selection(frecency_path, selected)
+        print(selected, flush=True)
+    if feeder.is_alive():
+        # Leave without waiting for the abandoned walk and its thread pool
+        os._exit(0 if selected else 1)
+    if not selected:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -6,11 +6,13 @@
 """Create a new git branch with an AI-generated or user-provided name."""
 
 import re
-import shutil
 import subprocess
 import sys
 from datetime import datetime
 
+from diffprompt import build_diff_prompt
+from llm import complete
+
 
 def run(*args, **kwargs):
     """Run a command and return its result."""
@@ -33,20 +35,19 @@ def sanitize_branch(name):
 
 
 def generate_branch_name(prompt_text=None):
-    """Generate a branch name using copilot or fallback to timestamp."""
-    copilot = shutil.which("copilot")
-
-    diff = run("git", "diff", "HEAD").stdout.strip()
-    untracked = run("git", "ls-files", "--others", "--exclude-standard").stdout.strip()
+    """Generate a branch name using the LLM backend or fallback to timestamp."""
+    diff = run("git", "diff", "HEAD", errors="replace").stdout.strip()
+    untracked = run("git", "ls-files", "--others", "--exclude-standard").stdout.splitlines()
     has_changes = bool(diff or untracked)
+    summary = build_diff_prompt(diff, untracked=untracked) if has_changes else ""
 
-    if copilot and (prompt_text or has_changes):
+    if prompt_text or has_changes:
         if prompt_text and has_changes:
             prompt = (
                 f"Read the following changes and the prompt: '{prompt_text}'. "
                 "Generate a short, descriptive git branch name (lowercase, hyphens, "
                 "no special chars, max 50 chars). Output ONLY the branch name.\n\n"
-                f"{diff}"
+                f"{summary}"
             )
         elif prompt_text:
             prompt = (
@@ -57,12 +58,12 @@ def generate_branch_name(prompt_text=None):
             prompt = (
                 "Generate a short, descriptive git branch name from these changes. "
                 "Lowercase, hyphens, no special chars, max 50 chars. Output ONLY the branch name.\n\n"
-                f"{diff}"
+                f"{summary}"
             )
 
-        result = run(copilot, "--silent", "--allow-all-tools", "--model", "gpt-4.1", input=prompt)
-        if result.returncode == 0 and result.stdout.strip():
-            return sanitize_branch(result.stdout.strip())
+        name = complete(prompt)
+        if name and sanitize_branch(name):
+            return sanitize_branch(name)
 
     return datetime.now().strftime("%Y%m%d%H%M%S")
 
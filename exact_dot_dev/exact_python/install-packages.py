@@ -13,16 +13,29 @@ checks what's already present, and installs only what's missing.
 """
 
 import argparse
+import asyncio
+import atexit
+import contextvars
+import functools
+import hashlib
+import itertools
+import json
+import locale
 import os
 import platform
 import re
 import shutil
+import signal
 import subprocess
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
+from typing import NamedTuple
 
-import yaml
+from statedir import read_json, state_dir, write_json
 
 
 def get_os() -> str:
@@ -35,79 +48,1177 @@ def get_os() -> str:
     return "linux"
 
 
-def run_silent(cmd: str, shell: bool = True) -> int:
-    """Run a command silently, return exit code."""
-    try:
-        result = subprocess.run(
-            cmd, shell=shell, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+# Default per-command timeouts in seconds, overridden by the manifest's
+# top-level `timeouts` and then by each source's own `timeouts`
+DEFAULT_TIMEOUTS: dict[str, float] = {"probe": 30, "check": 120, "prefetch": 900, "install": 1800}
+
+
+def source_timeout(source_cfg: dict, kind: str) -> float | None:
+    """Return the timeout budget of kind probe/check/prefetch/install for a source."""
+    return source_cfg.get("timeouts", {}).get(kind, DEFAULT_TIMEOUTS.get(kind))
+
+
+class Deadline:
+    """Overall time budget for the run; commands never outlive it."""
+
+    def __init__(self, seconds: float | None = None):
+        self.end = time.monotonic() + seconds if seconds else None
+
+    def remaining(self) -> float | None:
+        return None if self.end is None else self.end - time.monotonic()
+
+    def clamp(self, timeout: float | None) -> float | None:
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+
+deadline = Deadline()
+
+
+class CommandResult(NamedTuple):
+    returncode: int
+    stdout: str
+    timed_out: bool = False
+
+
+def kill_process_tree(proc: subprocess.Popen | asyncio.subprocess.Process):
+    """Kill a shell process along with everything it spawned."""
+    if sys.platform == "win32":
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(proc.pid)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
         )
-        return result.returncode
-    except Exception:
-        return 1
+        try:
+            proc.kill()
+        except OSError:
+            pass
+    else:
+        # Not a process group: installs must stay in the terminal's foreground
+        # group so sudo can prompt, so walk the ppid tree instead. The tree
+        # starts at proc itself; proc.kill() would poll first and could reap
+        # the child behind asyncio's back.
+        try:
+            ps = subprocess.run(["ps", "-A", "-o", "pid=,ppid="], capture_output=True, text=True, timeout=10).stdout
+        except Exception:
+            ps = ""
+        children: dict[int, list[int]] = {}
+        for line in ps.splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                children.setdefault(int(parts[1]), []).append(int(parts[0]))
+        tree, stack = [], [proc.pid]
+        while stack:
+            pid = stack.pop()
+            tree.append(pid)
+            stack.extend(children.get(pid, []))
+        for pid in tree:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+SECRET_ARG = re.compile(r"(--[\w-]*(?:token|password|secret)[\w-]*[= ]|\b\w*(?:TOKEN|PASSWORD|SECRET)\w*=)\S+", re.IGNORECASE)
+
+
+def redact(cmd: str) -> str:
+    """Mask token/password arguments and assignments in a command line before it is logged or traced."""
+    return SECRET_ARG.sub(r"\1***", cmd)
+
+
+class Tracer:
+    """Records run phases and every spawned command for --timings / --trace.
+
+    Commands are tagged with the source/package of the enclosing tags()
+    block in the same thread or asyncio task. Events are kept as Chrome
+    trace-event "X" (complete) events so they can be dumped straight into
+    chrome://tracing or Perfetto.
+    """
+
+    LANE_BASE = 1 << 20  # tids for lanes, well clear of real thread ids' low bits
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.origin = time.perf_counter()
+        self.events: list[dict] = []
+        self.threads: dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._tags: contextvars.ContextVar[dict] = contextvars.ContextVar("trace_tags", default={})
+        self._lane: contextvars.ContextVar[int | None] = contextvars.ContextVar("trace_lane", default=None)
+        self._busy_lanes: set[int] = set()
+        self._phase: tuple[str, float] | None = None
+
+    @contextmanager
+    def tags(self, **tags):
+        """Attach tags (source=, package=) to commands run in this context."""
+        token = self._tags.set({**self._tags.get(), **tags})
+        try:
+            yield
+        finally:
+            self._tags.reset(token)
+
+    def current_tags(self) -> dict:
+        return dict(self._tags.get())
+
+    @contextmanager
+    def lane(self):
+        """Give the enclosing task its own row in the trace.
+
+        Every task on the command engine shares one thread, so without lanes
+        their overlapping events would be drawn on top of each other. Nested
+        lane() blocks reuse the outer lane.
+        """
+        if self._lane.get() is not None:
+            yield
+            return
+        with self._lock:
+            lane = next(i for i in itertools.count() if i not in self._busy_lanes)
+            self._busy_lanes.add(lane)
+        token = self._lane.set(lane)
+        try:
+            yield
+        finally:
+            self._lane.reset(token)
+            with self._lock:
+                self._busy_lanes.discard(lane)
+
+    def record(self, name: str, cat: str, start: float, end: float, args: dict | None = None):
+        if not self.enabled:
+            return
+        lane = self._lane.get()
+        if lane is None:
+            thread = threading.current_thread()
+            tid, thread_name = thread.ident, thread.name
+        else:
+            tid, thread_name = self.LANE_BASE + lane, f"lane {lane}"
+        event = {
+            "name": name, "cat": cat, "ph": "X", "pid": os.getpid(), "tid": tid,
+            "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6,
+            "args": {**self.current_tags(), **(args or {})},
+        }
+        with self._lock:
+            self.events.append(event)
+            self.threads[tid] = thread_name
+
+    @contextmanager
+    def span(self, name: str, cat: str = "phase", **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, cat, start, time.perf_counter(), args)
+
+    def phase(self, name: str | None):
+        """End the current top-level phase and start `name` (None just ends it)."""
+        now = time.perf_counter()
+        if self._phase:
+            self.record(self._phase[0], "phase", self._phase[1], now)
+        self._phase = (name, now) if name else None
+
+    def write(self, path: Path):
+        """Write a Chrome trace-event JSON file."""
+        metadata = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+            for tid, name in self.threads.items()
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, f)
+
+    def print_report(self, top: int = 10):
+        phases = [e for e in self.events if e["cat"] == "phase"]
+        commands = sorted((e for e in self.events if e["cat"] == "command"), key=lambda e: -e["dur"])
+        print("\n⏱  Timings")
+        for e in phases:
+            print(f"    {e['dur'] / 1e6:8.2f}s  {e['name']}")
+        if commands:
+            print(f"  Slowest of {len(commands)} command(s):")
+            for e in commands[:top]:
+                a = e["args"]
+                who = "/".join(str(a[k]) for k in ("source", "package") if a.get(k))
+                status = "timeout" if a.get("timed_out") else f"exit {a.get('exit_code')}"
+                print(f"    {e['dur'] / 1e6:8.2f}s  [{who or '-'}] {status}  {e['name'][:80]}")
 
 
-def run_capture(cmd: str, shell: bool = True) -> tuple[int, str]:
+tracer = Tracer()
+
+
+class CommandEngine:
+    """Runs every subprocess on one asyncio event loop in a background thread.
+
+    Commands are coroutines, so hundreds of probes and checks can be in
+    flight without an OS thread each; `limit` bounds how many of those run
+    at once (installs are throttled by InstallScheduler instead). Output can
+    be streamed line by line to a callback as it arrives. Synchronous code
+    reaches the loop through call(), gather() and submit(); the loop thread
+    is started on first use.
+    """
+
+    def __init__(self, limit: int = 32):
+        self.limit = limit
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._start_lock = threading.Lock()
+        self._encoding = locale.getpreferredencoding(False)
+
+    def submit(self, coro) -> Future:
+        """Schedule a coroutine on the loop; the caller's trace tags carry over."""
+        with self._start_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="command-engine", daemon=True).start()
+        future: Future = Future()
+        context = contextvars.copy_context()
+
+        def done(task: asyncio.Task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start():
+            self.loop.create_task(coro, context=context).add_done_callback(done)
+
+        self.loop.call_soon_threadsafe(start)
+        return future
+
+    def call(self, coro):
+        """Run a coroutine on the loop and wait for its result."""
+        return self.submit(coro).result()
+
+    def gather(self, coros) -> list:
+        """Run coroutines concurrently; returns their results in order."""
+        coros = list(coros)
+
+        async def run_all():
+            return await asyncio.gather(*coros)
+        return self.call(run_all())
+
+    async def run(
+        self, cmd: str, timeout: float | None = None, capture: bool = True, merge_stderr: bool = False,
+        on_line=None, limited: bool = True, env: dict[str, str] | None = None,
+    ) -> CommandResult:
+        """Run a shell command with a timeout, killing its whole process tree on expiry.
+
+        The timeout is clamped to the overall deadline; once that has passed,
+        nothing is spawned and the command is reported as timed out. Each
+        line of output is passed to on_line(line) as it arrives. Commands run
+        with `limited` wait for one of the engine's `limit` slots. `env` adds
+        variables to the command's environment.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(max(self.limit, 1))
+        async with self._semaphore if limited else nullcontext():
+            with tracer.lane():
+                start = time.perf_counter()
+                result = await self._run(cmd, timeout, capture, merge_stderr, on_line, env)
+                tracer.record(
+                    redact(cmd), "command", start, time.perf_counter(),
+                    {"exit_code": result.returncode, "timed_out": result.timed_out},
+                )
+        return result
+
+    def _decode(self, data: bytes) -> str:
+        return data.decode(self._encoding, errors="replace").replace("\r\n", "\n")
+
+    async def _run(
+        self, cmd: str, timeout: float | None, capture: bool, merge_stderr: bool, on_line, env: dict[str, str] | None,
+    ) -> CommandResult:
+        timeout = deadline.clamp(timeout)
+        if timeout is not None and timeout <= 0:
+            return CommandResult(1, "", timed_out=True)
+        try:
+            proc = await asyncio.create_subprocess_shell(
+                cmd,
+                stdout=asyncio.subprocess.PIPE if capture else asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.STDOUT if merge_stderr else asyncio.subprocess.DEVNULL,
+                env={**os.environ, **env} if env else None,
+            )
+        except Exception:
+            return CommandResult(1, "")
+
+        chunks: list[bytes] = []
+
+        async def pump() -> int:
+            pending = b""
+            while proc.stdout and (chunk := await proc.stdout.read(65536)):
+                chunks.append(chunk)
+                if on_line:
+                    *lines, pending = (pending + chunk).split(b"\n")
+                    for line in lines:
+                        on_line(self._decode(line).rstrip("\r"))
+            if on_line and pending:
+                on_line(self._decode(pending).rstrip("\r"))
+            return await proc.wait()
+
+        try:
+            returncode = await asyncio.wait_for(pump(), timeout)
+            return CommandResult(returncode, self._decode(b"".join(chunks)))
+        except TimeoutError:
+            await asyncio.to_thread(kill_process_tree, proc)
+            try:
+                await asyncio.wait_for(proc.wait(), 5)
+            except TimeoutError:
+                # Something we couldn't kill (e.g. a sudo child) is still running
+                pass
+            return CommandResult(1, self._decode(b"".join(chunks)), timed_out=True)
+
+
+engine = CommandEngine()
+
+
+def run_command(cmd: str, timeout: float | None = None, capture: bool = True, merge_stderr: bool = False) -> CommandResult:
+    """Run a command from synchronous code (never from a coroutine on the engine)."""
+    return engine.call(engine.run(cmd, timeout, capture, merge_stderr))
+
+
+def run_capture(cmd: str, timeout: float | None = None) -> CommandResult:
     """Run a command and capture stdout."""
-    try:
-        result = subprocess.run(
-            cmd, shell=shell, capture_output=True, text=True
-        )
-        return result.returncode, result.stdout
-    except Exception:
-        return 1, ""
+    return run_command(cmd, timeout)
+
+
+class PathIndex:
+    """In-memory index of the executables on PATH.
 
+    shutil.which() stats every PATH directory (times every PATHEXT extension
+    on Windows) per lookup, which is slow when PATH has dozens of entries on
+    /mnt/c. This lists each directory once, all directories in parallel, and
+    answers lookups from memory. The index is shared by concurrent resolvers and
+    built on first use; call invalidate() after installs change PATH contents.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index: dict[str, list[str]] | None = None
+        self._windows = sys.platform == "win32"
+        self._pathext = [
+            ext.lower() for ext in os.environ.get("PATHEXT", ".COM;.EXE;.BAT;.CMD").split(os.pathsep) if ext
+        ] if self._windows else []
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+    def which(self, binary: str) -> str | None:
+        """Return the path of `binary` on PATH, like shutil.which()."""
+        if os.sep in binary or (os.altsep and os.altsep in binary):
+            return shutil.which(binary)
+        with self._lock:
+            if self._index is None:
+                self._index = self._build()
+            candidates = self._index.get(binary.lower() if self._windows else binary, [])
+        for path in candidates:
+            if self._windows or os.access(path, os.X_OK):
+                return path
+        return None
 
-def check_source_available(source_cfg: dict) -> bool:
-    """Check if a package source is available on this system."""
+    def _scan(self, directory: str) -> list[tuple[str, str]]:
+        entries = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            entries.append((entry.name, entry.path))
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return entries
+
+    def _build(self) -> dict[str, list[str]]:
+        dirs = list(dict.fromkeys(d for d in os.environ.get("PATH", "").split(os.pathsep) if d))
+        index: dict[str, list[str]] = {}
+        with ThreadPoolExecutor(max_workers=min(len(dirs), 16) or 1) as pool:
+            # map() keeps PATH order, so earlier directories win like they do for which()
+            for entries in pool.map(self._scan, dirs):
+                for name, path in entries:
+                    if self._windows:
+                        name = name.lower()
+                        stem, ext = os.path.splitext(name)
+                        if ext in self._pathext:
+                            index.setdefault(stem, []).append(path)
+                    index.setdefault(name, []).append(path)
+        return index
+
+
+path_index = PathIndex()
+
+
+def extend_path(sources: dict[str, dict]) -> bool:
+    """Append each source's existing `paths` dirs to this process's PATH.
+
+    Toolchains installed mid-run (rustup, Go, PowerShell) land in dirs the
+    current PATH may not include yet. Returns True if PATH changed, in which
+    case the PATH index has been invalidated.
+    """
+    entries = os.environ.get("PATH", "").split(os.pathsep)
+    added = []
+    for cfg in sources.values():
+        for path in cfg.get("paths", []):
+            path = os.path.expanduser(os.path.expandvars(path))
+            if os.path.isdir(path) and path not in entries and path not in added:
+                added.append(path)
+    if not added:
+        return False
+    os.environ["PATH"] = os.pathsep.join(entries + added)
+    path_index.invalidate()
+    return True
+
+
+async def check_source_available(source_cfg: dict, probe_cache: dict | None = None) -> tuple[bool, bool]:
+    """Check if a package source is available on this system.
+
+    Returns (available, from_cache). The probe's program must be on PATH.
+    Successful probes are remembered in `probe_cache` against that program's
+    path and mtime, so unchanged toolchains aren't spawned again.
+    """
     cmd = source_cfg.get("available", "")
     if not cmd:
-        return False
-    return run_silent(cmd) == 0
+        return False, False
+    program = path_index.which(cmd.split()[0])
+    if not program:
+        return False, False
+    key = fingerprint([program])
+    if probe_cache is not None and probe_cache.get(cmd) == key:
+        return True, True
+    ok = (await engine.run(cmd, source_timeout(source_cfg, "probe"), capture=False)).returncode == 0
+    if probe_cache is not None:
+        if ok:
+            probe_cache[cmd] = key
+        else:
+            probe_cache.pop(cmd, None)
+    return ok, False
 
 
-def check_package_installed(pkg_id: str, source_name: str, source_cfg: dict, pkg_cfg: dict) -> bool:
-    """Check if a package is already installed."""
-    # Method 1: check_cmd + check_grep (list and grep)
-    if "check_cmd" in source_cfg and "check_grep" in source_cfg:
-        pattern = source_cfg["check_grep"].replace("{pkg}", re.escape(pkg_id))
-        rc, stdout = run_capture(source_cfg["check_cmd"])
-        if rc != 0:
+def _json_nodes(node, path: str) -> list:
+    """Walk a dotted path through parsed JSON, flattening lists along the way."""
+    nodes = [node]
+    for key in path.split(".") if path else []:
+        step = []
+        for n in nodes:
+            for item in n if isinstance(n, list) else [n]:
+                if isinstance(item, dict) and key in item:
+                    step.append(item[key])
+        nodes = step
+    return nodes
+
+
+def parse_inventory(output: str, parse_cfg: dict) -> dict[str, str | None] | None:
+    """Parse check_cmd (or outdated_cmd) output into a {package_id: version} index.
+
+    parse_cfg declares the format:
+      regex: pattern with (?P<name>...) and optional (?P<version>...) groups,
+             matched against every line
+      json: dotted path(s) to a mapping of name -> info, or a list of objects
+            (name_key / version_key pick the fields; lists along the path are
+            flattened)
+      ignore_case: index names lowercased for case-insensitive lookups
+
+    Returns None if JSON output can't be parsed, so callers fall back to
+    checking packages one by one instead of trusting an empty index.
+    """
+    index: dict[str, str | None] = {}
+    if "regex" in parse_cfg:
+        for m in re.finditer(parse_cfg["regex"], output, re.MULTILINE):
+            index[m.group("name")] = m.groupdict().get("version")
+    elif "json" in parse_cfg:
+        try:
+            data = json.loads(output.lstrip("\ufeff"))
+        except ValueError:
+            return None
+        paths = parse_cfg["json"]
+        name_key = parse_cfg.get("name_key", "name")
+        version_key = parse_cfg.get("version_key", "version")
+        for path in [paths] if isinstance(paths, str) else paths:
+            for node in _json_nodes(data, path):
+                if isinstance(node, dict):
+                    for name, info in node.items():
+                        index[name] = info.get(version_key) if isinstance(info, dict) else info
+                elif isinstance(node, list):
+                    for item in node:
+                        if isinstance(item, dict) and name_key in item:
+                            index[item[name_key]] = item.get(version_key)
+    if parse_cfg.get("ignore_case"):
+        index = {name.lower(): version for name, version in index.items()}
+    return index
+
+
+def inventory_key(pkg_id: str, parse_cfg: dict) -> str:
+    """Return the key pkg_id is stored under in an index built with parse_cfg."""
+    if parse_cfg.get("ignore_case"):
+        return pkg_id.lower()
+    return pkg_id
+
+
+async def check_package_installed(
+    pkg_id: str, source_name: str, source_cfg: dict, pkg_cfg: dict,
+    inventory: dict[str, str | None] | None = None,
+) -> bool:
+    """Check if a package is already installed.
+
+    `inventory` is the source's parsed check_cmd index, or None if the source
+    has no inventory or fetching it failed.
+    """
+    # Method 1: check_cmd + check_parse (one inventory per source, O(1) lookups)
+    if "check_cmd" in source_cfg:
+        if inventory is not None:
+            return inventory_key(pkg_id, source_cfg.get("check_parse", {})) in inventory
+        if "check" not in source_cfg:
             return False
-        return bool(re.search(pattern, stdout, re.MULTILINE))
 
     # Method 2: check_binary (for go packages — check if the binary exists)
     if source_cfg.get("check_binary"):
         binary = pkg_cfg.get("binary", pkg_id.split("/")[-1])
-        return shutil.which(binary) is not None
+        return path_index.which(binary) is not None
 
-    # Method 3: check command template (exit code based)
+    # Method 3: check command template (exit code based), also the fallback
+    # when a source's inventory command fails
     if "check" in source_cfg:
         cmd = source_cfg["check"].replace("{pkg}", pkg_id)
-        return run_silent(cmd) == 0
+        return (await engine.run(cmd, source_timeout(source_cfg, "check"), capture=False)).returncode == 0
 
     # Fallback: check if binary is in PATH
     binary = pkg_cfg.get("binary", pkg_id)
-    return shutil.which(binary) is not None
+    return path_index.which(binary) is not None
+
+
+def expand_template(template: str, pkg_ids: list[str]) -> str:
+    """Substitute package ids into a command template.
+
+    Each word containing {pkg} is repeated once per id, so
+    "go install {pkg}@latest" expands to "go install a@latest b@latest".
+    """
+    return re.sub(
+        r"\S*\{pkg\}\S*",
+        lambda m: " ".join(m.group(0).replace("{pkg}", pkg_id) for pkg_id in pkg_ids),
+        template,
+    )
+
+
+class Console:
+    """Terminal and log output shared by concurrent install jobs.
+
+    Every line a command prints goes to per-package log files under
+    `log_dir`. On the terminal, --verbose streams each line as it arrives
+    with a [source/pkg] prefix; otherwise interactive terminals get a compact
+    live view with one line per running command showing its latest output,
+    redrawn in place below the finished blocks. Finished blocks go through
+    emit() so they never tear through the live view.
+    """
+
+    KEEP_LOGS = 10  # runs whose log directories are kept
+
+    def __init__(self, log_dir: Path, verbose: bool = False):
+        self.log_dir = log_dir
+        self.verbose = verbose
+        self.live = not verbose and sys.stdout.isatty() and os.environ.get("TERM") != "dumb"
+        if self.live and sys.platform == "win32":
+            os.system("")  # turns on ANSI escape handling in the Windows console
+        self.running: dict[int, list[str]] = {}  # job id -> [icon + label, latest line]
+        self.drawn = 0
+        self.last_draw = 0.0
+        self.lock = threading.Lock()
+        self._ids = itertools.count()
+        self._prune()
+
+    def log_path(self, source_name: str, pkg_id: str) -> Path:
+        safe_id = re.sub(r"[^\w.@+-]", "_", pkg_id)
+        return self.log_dir / f"{source_name}-{safe_id}.log"
+
+    def emit(self, text: str):
+        """Print finished output above the live view."""
+        with self.lock:
+            self._clear()
+            print(text, flush=True)
+            self._draw()
+
+    @contextmanager
+    def job(self, source_name: str, pkg_ids: list[str], cmd: str, icon: str = "⏳"):
+        """Track one running command; yields the on_line callback for its output."""
+        label = f"[{source_name}/{pkg_ids[0]}" + (f" +{len(pkg_ids) - 1}" if len(pkg_ids) > 1 else "") + "]"
+        logs = []
+        try:
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+            for pkg_id in pkg_ids:
+                f = open(self.log_path(source_name, pkg_id), "a", encoding="utf-8")
+                f.write(f"$ {redact(cmd)}\n")
+                logs.append(f)
+        except OSError:
+            pass
+        job_id = next(self._ids)
+
+        def on_line(line: str):
+            for f in logs:
+                f.write(line + "\n")
+            with self.lock:
+                if self.verbose:
+                    print(f"{label} {line}", flush=True)
+                elif self.live:
+                    self.running[job_id][1] = line
+                    if time.monotonic() - self.last_draw > 0.1:
+                        self._clear()
+                        self._draw()
+
+        with self.lock:
+            self.running[job_id] = [f"{icon} {label}", redact(cmd)]
+            self._clear()
+            self._draw()
+        try:
+            yield on_line
+        finally:
+            for f in logs:
+                f.close()
+            with self.lock:
+                del self.running[job_id]
+                self._clear()
+                self._draw()
+
+    def _clear(self):
+        if self.drawn:
+            sys.stdout.write(f"\x1b[{self.drawn}F\x1b[J")
+            self.drawn = 0
+
+    def _draw(self):
+        if not self.live or not self.running:
+            return
+        width = shutil.get_terminal_size().columns - 4
+        lines = []
+        for label, latest in self.running.values():
+            # Keep only what a progress bar last drew, minus colour codes
+            latest = re.sub(r"\x1b\[[0-9;?]*[A-Za-z]", "", latest.rsplit("\r", 1)[-1]).expandtabs()
+            lines.append(f"  {label} {latest}"[:width])
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+        self.drawn = len(lines)
+        self.last_draw = time.monotonic()
+
+    def _prune(self):
+        try:
+            runs = sorted(p for p in self.log_dir.parent.iterdir() if p.is_dir())
+        except OSError:
+            return
+        for old in runs[:-(self.KEEP_LOGS - 1)]:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+async def install_package(
+    pkg_ids: list[str], source_name: str, source_cfg: dict, log: list[str], console: Console,
+) -> str:
+    """Install one or more packages with a single command.
+
+    Returns "ok", "failed" or "timed out". The command line and its combined
+    output are appended to `log` for the source's summary block; the output
+    is also streamed to `console` as it arrives.
+    """
+    cmd = expand_template(source_cfg["install"], pkg_ids)
+    log.append(f"  → {redact(cmd)}")
+    timeout = source_timeout(source_cfg, "install")
+    with tracer.tags(source=source_name, package=",".join(pkg_ids)):
+        with console.job(source_name, pkg_ids, cmd) as on_line:
+            result = await engine.run(
+                cmd, timeout, merge_stderr=True, on_line=on_line, limited=False, env=source_cfg.get("env"),
+            )
+    log.extend(f"    {line}" for line in result.stdout.splitlines())
+    if result.timed_out:
+        log.append("    ⏱ Timed out" + (f" after {timeout:g}s" if timeout else ""))
+        return "timed out"
+    return "ok" if result.returncode == 0 else "failed"
+
+
+async def install_packages(
+    pkgs: list[tuple[str, str]], source_name: str, source_cfg: dict, log: list[str], console: Console,
+) -> dict[str, str]:
+    """Install (pkg_name, pkg_id) pairs from one source.
+
+    Returns {pkg_name: "failed" | "timed out"} for packages that didn't
+    install. Sources marked `batch: true` get one command for the whole
+    group. If it fails, the group is bisected so a single bad package only
+    fails itself; a batch that times out isn't retried.
+    """
+    if not source_cfg.get("batch") or len(pkgs) == 1:
+        failures = {}
+        for name, pkg_id in pkgs:
+            status = await install_package([pkg_id], source_name, source_cfg, log, console)
+            if status != "ok":
+                failures[name] = status
+        return failures
+
+    status = await install_package([pkg_id for _, pkg_id in pkgs], source_name, source_cfg, log, console)
+    if status == "ok":
+        return {}
+    if status == "timed out":
+        return {name: status for name, _ in pkgs}
+
+    mid = len(pkgs) // 2
+    log.append(f"    ✗ Batch of {len(pkgs)} failed, retrying in halves")
+    return (
+        await install_packages(pkgs[:mid], source_name, source_cfg, log, console)
+        | await install_packages(pkgs[mid:], source_name, source_cfg, log, console)
+    )
+
+
+async def prefetch_packages(pkg_ids: list[str], source_name: str, source_cfg: dict, console: Console) -> bool:
+    """Download packages without installing them, using the source's `prefetch`
+    command (batched like installs). Returns True if every download succeeded;
+    failures are harmless since the install downloads whatever is missing."""
+    groups = [pkg_ids] if source_cfg.get("batch") else [[pkg_id] for pkg_id in pkg_ids]
+    ok = True
+    for group in groups:
+        cmd = expand_template(source_cfg["prefetch"], group)
+        with tracer.tags(source=source_name, package=",".join(group)):
+            with console.job(source_name, group, cmd, icon="⬇") as on_line:
+                result = await engine.run(
+                    cmd, source_timeout(source_cfg, "prefetch"), merge_stderr=True, on_line=on_line, limited=False,
+                    env=source_cfg.get("env"),
+                )
+        ok = ok and result.returncode == 0 and not result.timed_out
+    return ok
+
+
+class InstallScheduler:
+    """Run per-source install jobs concurrently on the command engine.
+
+    Each source's packages are installed in order by one job, but jobs for
+    different sources overlap. A source's `lock` names a machine-wide resource
+    (e.g. `system` for apt/dpkg and snap); jobs sharing a lock run one at a
+    time. Sources without a lock are user-level toolchains and share a pool of
+    `jobs` slots.
+
+    Sources with a `prefetch` command can download ahead of time: up to
+    `prefetch_jobs` prefetches run while earlier installs are in progress,
+    and a source's install job waits for its own prefetch so the two never
+    fight over the same package cache. Prefetches don't take the source's
+    lock: a download doesn't touch the resource installs are serialised on,
+    so apt can download while snap installs.
+    """
+
+    def __init__(self, jobs: int, console: Console, prefetch_jobs: int = 2):
+        self.console = console
+        self.user_slots = asyncio.Semaphore(max(jobs, 1))
+        self.prefetch_slots = asyncio.Semaphore(max(prefetch_jobs, 1))
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.prefetches: dict[str, Future] = {}
+        self.futures: list[Future] = []
+
+    def prefetch(self, src_name: str, src_cfg: dict, pkg_ids: list[str]):
+        """Start downloading a source's packages, if it has a prefetch command."""
+        if src_cfg.get("prefetch"):
+            self.prefetches[src_name] = engine.submit(self._prefetch(src_name, src_cfg, pkg_ids))
+            self.futures.append(self.prefetches[src_name])
+
+    def submit(self, src_name: str, src_cfg: dict, pkgs: list[tuple[str, str]]) -> Future:
+        """Queue an install job. The future resolves to a list of (pkg_name, status)."""
+        future = engine.submit(self._run(src_name, src_cfg, pkgs))
+        self.futures.append(future)
+        return future
+
+    def shutdown(self):
+        wait(self.futures)
+
+    def _slot(self, src_cfg: dict):
+        lock_name = src_cfg.get("lock")
+        if not lock_name:
+            return self.user_slots
+        return self.locks.setdefault(lock_name, asyncio.Lock())
+
+    async def _prefetch(self, src_name: str, src_cfg: dict, pkg_ids: list[str]):
+        with tracer.lane(), tracer.span(f"prefetch {src_name}", cat="prefetch", source=src_name, packages=len(pkg_ids)):
+            async with self.prefetch_slots:
+                ok = await prefetch_packages(pkg_ids, src_name, src_cfg, self.console)
+        if self.console.verbose:
+            self.console.emit(f"⬇  {src_name}: prefetched {len(pkg_ids)} package(s)" + ("" if ok else " (with errors)"))
+
+    async def _run(self, src_name: str, src_cfg: dict, pkgs: list[tuple[str, str]]) -> list[tuple[str, str]]:
+        prefetch = self.prefetches.pop(src_name, None)
+        if prefetch:
+            await asyncio.wrap_future(prefetch)
+        log: list[str] = []
+        with tracer.lane(), tracer.span(f"install {src_name}", cat="install", source=src_name, packages=len(pkgs)):
+            async with self._slot(src_cfg):
+                failed = await install_packages(pkgs, src_name, src_cfg, log, self.console)
+        results = [(pkg_name, failed.get(pkg_name, "ok")) for pkg_name, _ in pkgs]
+
+        lines = [f"📦 {src_name} ({len(pkgs)} packages):"]
+        for line in log:
+            # Command lines always; output on failure, unless --verbose already streamed it
+            if line.startswith("  →") or (failed and not self.console.verbose):
+                lines.append(line)
+        pkg_ids = dict(pkgs)
+        for pkg_name, status in results:
+            if status == "ok":
+                lines.append(f"    ✓ {pkg_name}")
+            else:
+                lines.append(f"    ✗ {pkg_name}" + (" (timed out)" if status == "timed out" else ""))
+                lines.append(f"      log: {self.console.log_path(src_name, pkg_ids[pkg_name])}")
+        self.console.emit("\n".join(lines) + "\n")
+        return results
+
 
+def fingerprint(paths: list[str]) -> dict[str, int | None]:
+    """Return {path: mtime_ns} for each path, None for paths that don't exist."""
+    result: dict[str, int | None] = {}
+    for path in paths:
+        path = os.path.expanduser(os.path.expandvars(path))
+        try:
+            result[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            result[path] = None
+    return result
 
-def install_package(pkg_id: str, source_name: str, source_cfg: dict) -> bool:
-    """Install a package. Returns True on success."""
-    cmd = source_cfg["install"].replace("{pkg}", pkg_id)
-    print(f"  → {cmd}")
-    result = subprocess.run(cmd, shell=True)
-    return result.returncode == 0
 
+class InstalledCache:
+    """On-disk record of which packages were found installed, and how.
 
+    Each entry carries the fingerprint that was current when the package was
+    detected: the mtimes of the source's `state_files` (dpkg status,
+    .crates2.json, ...) or of the binary found on PATH. While the fingerprint
+    still matches, the package is trusted as installed without spawning
+    anything. Sources without state_files are never cached.
+    """
+
+    def __init__(self, path: Path, enabled: bool = True):
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        self.current: dict[str, dict] = {}
+        self._source_fingerprints: dict[str, dict[str, int | None]] = {}
+        if enabled:
+            self.entries = (read_json(path) or {}).get("packages", {})
+
+    def source_fingerprint(self, src_name: str, src_cfg: dict) -> dict[str, int | None] | None:
+        if not src_cfg.get("state_files"):
+            return None
+        if src_name not in self._source_fingerprints:
+            self._source_fingerprints[src_name] = fingerprint(src_cfg["state_files"])
+        return self._source_fingerprints[src_name]
+
+    def lookup(self, pkg_name: str, pkg_cfg: dict, available_sources: dict[str, dict]) -> str | None:
+        """Return how a package was detected if its cached entry is still valid."""
+        entry = self.entries.get(pkg_name)
+        if not entry:
+            return None
+        if "binary" in entry:
+            if entry["binary"] != pkg_cfg.get("binary", pkg_name):
+                return None
+            current = fingerprint([entry["path"]])
+        else:
+            src_name = entry.get("source")
+            if src_name not in available_sources:
+                return None
+            if pkg_cfg.get("sources", {}).get(src_name) != entry.get("pkg_id"):
+                return None
+            current = self.source_fingerprint(src_name, available_sources[src_name])
+        if current is None or current != entry.get("fingerprint"):
+            return None
+        self.current[pkg_name] = entry
+        return entry["how"]
+
+    def record_binary(self, pkg_name: str, binary: str, path: str, how: str):
+        self.current[pkg_name] = {"binary": binary, "path": path, "how": how, "fingerprint": fingerprint([path])}
+
+    def record_source(self, pkg_name: str, src_name: str, src_cfg: dict, pkg_id: str, how: str):
+        current = self.source_fingerprint(src_name, src_cfg)
+        if current is not None:
+            self.current[pkg_name] = {"source": src_name, "pkg_id": pkg_id, "how": how, "fingerprint": current}
+
+    def save(self, checked: set[str]):
+        """Persist entries, dropping packages that were checked and not found installed."""
+        entries = {name: e for name, e in self.entries.items() if name not in checked}
+        entries.update(self.current)
+        write_json(self.path, {"packages": entries})
+
+
+class ManifestSnapshot:
+    """The last applied manifest for one profile/OS, used to skip unchanged packages.
+
+    Only packages that ended up installed are stored, so anything that failed
+    or was skipped is resolved again next run. A package is affected (and
+    re-resolved) when it is new or its entry changed, when one of its sources'
+    definitions changed, or when source_preference reorders its sources.
+    """
+
+    def __init__(self, path: Path, source_prefs: list[str], sources: dict, packages: dict):
+        self.path = path
+        # Round-trip through JSON so later in-place edits (e.g. the cargo
+        # github token) don't leak into the snapshot, and so it compares
+        # equal to what was loaded from disk
+        self.current = json.loads(json.dumps({
+            "source_preference": source_prefs, "sources": sources, "packages": packages,
+        }))
+        self.previous: dict | None = read_json(path)
+
+    @staticmethod
+    def _ordering(snapshot: dict, pkg_cfg: dict) -> list[str]:
+        return [s for s in snapshot["source_preference"] if s in pkg_cfg.get("sources", {})]
+
+    def affected(self) -> set[str] | None:
+        """Return the packages to resolve, or None if there is no usable snapshot."""
+        prev = self.previous
+        if not prev or set(prev) != set(self.current):
+            return None
+        changed_sources = {
+            name for name in set(prev["sources"]) | set(self.current["sources"])
+            if prev["sources"].get(name) != self.current["sources"].get(name)
+        }
+        affected = set()
+        for pkg_name, pkg_cfg in self.current["packages"].items():
+            old_cfg = prev["packages"].get(pkg_name)
+            if (
+                old_cfg != pkg_cfg
+                or changed_sources & set(pkg_cfg.get("sources", {}))
+                or self._ordering(prev, old_cfg) != self._ordering(self.current, pkg_cfg)
+            ):
+                affected.add(pkg_name)
+        return affected
+
+    def save(self, installed: set[str]):
+        snapshot = dict(self.current)
+        snapshot["packages"] = {n: c for n, c in self.current["packages"].items() if n in installed}
+        write_json(self.path, snapshot)
+
+
+def validate_timeouts(where: str, timeouts) -> list[str]:
+    """Return problems with a `timeouts` mapping (kind -> seconds)."""
+    if not isinstance(timeouts, dict):
+        return [f"{where} timeouts must be a mapping"]
+    return [
+        f"{where} has an invalid timeout {kind}: {value!r}"
+        for kind, value in timeouts.items()
+        if kind not in DEFAULT_TIMEOUTS or isinstance(value, bool) or not isinstance(value, (int, float))
+    ]
+
+
+def validate_manifest(manifest) -> list[str]:
+    """Return a list of problems with the manifest's structure (empty if valid)."""
+    if not isinstance(manifest, dict):
+        return ["manifest must be a mapping"]
+    errors = validate_timeouts("manifest", manifest.get("timeouts", {}))
+    sources = manifest.get("sources")
+    if not isinstance(sources, dict):
+        return ["'sources' must be a mapping"]
+    for name, cfg in sources.items():
+        if not isinstance(cfg, dict):
+            errors.append(f"source '{name}' must be a mapping")
+            continue
+        for key in ("available", "install"):
+            if not isinstance(cfg.get(key), str):
+                errors.append(f"source '{name}' needs an '{key}' command")
+        for parse_key in ("check_parse", "outdated_parse"):
+            parse_cfg = cfg.get(parse_key, {})
+            if not isinstance(parse_cfg, dict):
+                errors.append(f"source '{name}' {parse_key} must be a mapping")
+                continue
+            regex = parse_cfg.get("regex")
+            if regex is None:
+                continue
+            if not isinstance(regex, str):
+                errors.append(f"source '{name}' {parse_key} regex must be a string")
+                continue
+            try:
+                if "name" not in re.compile(regex).groupindex:
+                    errors.append(f"source '{name}' {parse_key} regex has no (?P<name>...) group")
+            except re.error as e:
+                errors.append(f"source '{name}' {parse_key} regex is invalid: {e}")
+        errors.extend(validate_timeouts(f"source '{name}'", cfg.get("timeouts", {})))
+    for name, profile in (manifest.get("profiles") or {}).items():
+        for os_name, prefs in (profile.get("source_preference") or {}).items():
+            for src in prefs:
+                if src not in sources:
+                    errors.append(f"profile '{name}' prefers unknown source '{src}' on {os_name}")
+    for name, cfg in (manifest.get("packages") or {}).items():
+        if not isinstance(cfg, dict) or not isinstance(cfg.get("sources"), dict):
+            errors.append(f"package '{name}' needs a 'sources' mapping")
+            continue
+        for src, pkg_id in cfg["sources"].items():
+            if src not in sources:
+                errors.append(f"package '{name}' uses unknown source '{src}'")
+            elif not isinstance(pkg_id, str):
+                errors.append(f"package '{name}' has a non-string id for '{src}'")
+        for src in cfg.get("provides", []):
+            if src not in sources:
+                errors.append(f"package '{name}' provides unknown source '{src}'")
+    return errors
+
+
+def load_manifest(path: Path) -> dict:
+    """Load and validate packages.yaml.
+
+    A validated copy is compiled to JSON in the state dir, keyed by the
+    manifest's sha256, so later runs skip YAML parsing (and importing yaml)
+    entirely. Parsing uses libyaml's CSafeLoader when available.
+    """
+    data = path.read_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    compiled_path = state_dir("install-packages") / "manifest-compiled.json"
+    compiled = read_json(compiled_path)
+    if isinstance(compiled, dict) and compiled.get("sha256") == digest:
+        return compiled["manifest"]
+
+    import yaml
+    manifest = yaml.load(data, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    errors = validate_manifest(manifest)
+    if errors:
+        print(f"✗ Invalid manifest {path}:", file=sys.stderr)
+        for error in errors:
+            print(f"    {error}", file=sys.stderr)
+        sys.exit(1)
+    write_json(compiled_path, {"sha256": digest, "manifest": manifest})
+    return manifest
+
+
+@functools.cache
 def get_github_token() -> str | None:
     """Get GitHub token for cargo-binstall rate limiting."""
-    if not shutil.which("gh"):
+    if not path_index.which("gh"):
         return None
-    rc, stdout = run_capture("gh auth token")
+    rc, stdout, _ = run_capture("gh auth token", timeout=30)
     if rc == 0 and stdout.strip():
         return stdout.strip()
     return None
 
 
+def apply_github_token(src_cfg: dict, key: str = "install"):
+    """Pass a GitHub token to cargo-binstall in src_cfg[key], if one is available.
+
+    The token goes into the command's environment (cargo-binstall reads
+    GITHUB_TOKEN) rather than its command line, which is logged and traced.
+    """
+    cmd = src_cfg.get(key, "")
+    if "cargo binstall" not in cmd or "--github-token" in cmd or os.environ.get("GITHUB_TOKEN"):
+        return
+    gh_token = get_github_token()
+    if gh_token:
+        src_cfg["env"] = {**src_cfg.get("env", {}), "GITHUB_TOKEN": gh_token}
+
+
+def print_failures(failures: list[tuple[str, str, str]], action: str, log_dir: Path):
+    """Print the (pkg_name, source_name, status) failure summary."""
+    print(f"\n⚠ {len(failures)} package(s) failed to {action}:")
+    for pkg_name, src_name, status in failures:
+        print(f"    {pkg_name} ({src_name}" + (", timed out)" if status == "timed out" else ")"))
+    print(f"📝 Logs: {log_dir}")
+
+
+def make_console(args) -> Console:
+    """Console for this run, logging under a fresh timestamped directory."""
+    return Console(state_dir("install-packages") / "logs" / time.strftime("%Y%m%d-%H%M%S"), verbose=args.verbose)
+
+
+def prime_sudo(src_cfgs: list[dict]):
+    """Ask for the sudo password up front if any `lock: system` source has work.
+
+    Those sources run sudo while other jobs are printing, and the live view
+    would redraw over its password prompt, so the credentials are cached
+    here (and kept fresh in the background) before the scheduler starts.
+    """
+    if sys.platform == "win32" or os.geteuid() == 0 or not sys.stdin.isatty():
+        return
+    if not any(cfg.get("lock") == "system" for cfg in src_cfgs) or not path_index.which("sudo"):
+        return
+    if subprocess.run(["sudo", "-v"]).returncode != 0:
+        print("⚠ sudo authentication failed; system packages will likely fail to install")
+        return
+
+    def keep_alive():
+        while subprocess.run(["sudo", "-n", "-v"], capture_output=True).returncode == 0:
+            time.sleep(60)
+
+    threading.Thread(target=keep_alive, name="sudo-keepalive", daemon=True).start()
+
+
+def run_upgrades(args, packages: dict, source_prefs: list[str], available_sources: dict[str, dict]):
+    """--upgrade: upgrade the profile's outdated packages.
+
+    Each source with an `outdated_cmd` is asked once (all in parallel) for
+    its outdated set, parsed with `outdated_parse` like an inventory. That set
+    is intersected with the profile's packages, and matches are upgraded with
+    the source's `upgrade` command through the same batched, lock-aware
+    scheduler as installs.
+    """
+    upgradable_sources = {
+        name: cfg for name, cfg in available_sources.items() if cfg.get("outdated_cmd") and cfg.get("upgrade")
+    }
+    outdated: dict[str, dict[str, str | None]] = {}
+
+    async def fetch(src_name: str):
+        cfg = upgradable_sources[src_name]
+        with tracer.tags(source=src_name):
+            # Exit codes are ignored: npm outdated exits 1 when anything is outdated
+            result = await engine.run(cfg["outdated_cmd"], source_timeout(cfg, "check"))
+        if result.timed_out:
+            print(f"  ⚠ {src_name} outdated check timed out")
+            return
+        parsed = parse_inventory(result.stdout, cfg.get("outdated_parse", {}))
+        if parsed is None:
+            print(f"  ⚠ {src_name} outdated output couldn't be parsed")
+            return
+        outdated[src_name] = parsed
+
+    tracer.phase("fetch outdated")
+    engine.gather(fetch(src_name) for src_name in upgradable_sources)
+
+    # First source in preference order that has the package outdated wins
+    by_source: dict[str, list[tuple[str, str, str | None]]] = {}
+    for pkg_name, pkg_cfg in packages.items():
+        pkg_sources = pkg_cfg.get("sources", {})
+        for src_name in source_prefs:
+            if src_name not in outdated or src_name not in pkg_sources:
+                continue
+            pkg_id = pkg_sources[src_name]
+            key = inventory_key(pkg_id, upgradable_sources[src_name].get("outdated_parse", {}))
+            if key in outdated[src_name]:
+                by_source.setdefault(src_name, []).append((pkg_name, pkg_id, outdated[src_name][key]))
+                break
+
+    count = sum(len(pkgs) for pkgs in by_source.values())
+    print(f"⬆  Upgradable: {count}")
+    for src_name, pkgs in by_source.items():
+        print(f"  [{src_name}]")
+        for pkg_name, pkg_id, version in pkgs:
+            print(f"    {pkg_name} ({pkg_id})" + (f" → {version}" if version else ""))
+    print()
+    if not count:
+        print("✅ Everything is up to date!")
+        return
+    if args.dry_run:
+        return
+
+    tracer.phase("upgrade")
+    failures: list[tuple[str, str, str]] = []
+    prime_sudo([upgradable_sources[src_name] for src_name in by_source])
+    scheduler = InstallScheduler(args.jobs, make_console(args), args.prefetch_jobs)
+    jobs = {}
+    for src_name, pkgs in by_source.items():
+        # The scheduler runs `install`; point it at the upgrade command instead
+        cfg = {**upgradable_sources[src_name], "install": upgradable_sources[src_name]["upgrade"]}
+        apply_github_token(cfg)
+        if not args.no_prefetch:
+            scheduler.prefetch(src_name, cfg, [pkg_id for _, pkg_id, _ in pkgs])
+        jobs[scheduler.submit(src_name, cfg, [(name, pkg_id) for name, pkg_id, _ in pkgs])] = src_name
+    for future in as_completed(jobs):
+        for pkg_name, status in future.result():
+            if status != "ok":
+                failures.append((pkg_name, jobs[future], status))
+    scheduler.shutdown()
+
+    if failures:
+        print_failures(failures, "upgrade", scheduler.console.log_dir)
+        sys.exit(1)
+    print("\n✅ All packages upgraded!")
+
+
+def report_timings(args):
+    """Close the last phase and emit --timings / --trace output (runs at exit)."""
+    tracer.phase(None)
+    if args.trace:
+        tracer.write(args.trace)
+        print(f"\n📈 Trace written to {args.trace}")
+    tracer.print_report()
+
+
 def main():
     parser = argparse.ArgumentParser(description="Declarative cross-platform package installer")
     parser.add_argument(
@@ -121,15 +1232,53 @@ def main():
     )
     parser.add_argument("--dry-run", action="store_true", help="Show what would be installed without installing")
     parser.add_argument("--source", type=str, help="Only install from a specific source")
+    parser.add_argument(
+        "--upgrade", action="store_true",
+        help="Upgrade the profile's outdated packages instead of installing missing ones",
+    )
     parser.add_argument("--verbose", action="store_true", help="Show detailed output")
+    parser.add_argument(
+        "--jobs", type=int, default=4,
+        help="Max concurrent installs from user-level sources (default: 4)",
+    )
+    parser.add_argument(
+        "--prefetch-jobs", type=int, default=2,
+        help="Max concurrent downloads ahead of installs (default: 2)",
+    )
+    parser.add_argument("--no-prefetch", action="store_true", help="Don't download packages ahead of installing them")
+    parser.add_argument(
+        "--workers", type=int, default=32,
+        help="Max concurrent probe/check commands while resolving (default: 32)",
+    )
+    parser.add_argument(
+        "--deadline", type=float,
+        help="Overall time budget in seconds; commands still running when it passes are killed",
+    )
+    parser.add_argument("--timings", action="store_true", help="Print phase timings and the slowest commands")
+    parser.add_argument("--trace", type=Path, help="Write a Chrome trace-event JSON of phases and commands")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore the installed-state cache and rescan everything")
+    parser.add_argument(
+        "--full", action="store_true",
+        help="Resolve every package, not just those changed since the last applied manifest",
+    )
     args = parser.parse_args()
 
+    global deadline, tracer
+    deadline = Deadline(args.deadline)
+    engine.limit = args.workers
+    tracer = Tracer(enabled=args.timings or bool(args.trace))
+    if tracer.enabled:
+        atexit.register(report_timings, args)
+
+    tracer.phase("load manifest")
+
     if not args.manifest.exists():
         print(f"✗ Manifest not found: {args.manifest}", file=sys.stderr)
         sys.exit(1)
 
-    with open(args.manifest) as f:
-        manifest = yaml.safe_load(f)
+    manifest = load_manifest(args.manifest)
+
+    DEFAULT_TIMEOUTS.update(manifest.get("timeouts", {}))
 
     current_os = get_os()
     profile_name = args.profile
@@ -158,16 +1307,34 @@ def main():
     print(f"🖥  OS: {current_os} | Profile: {profile_name}")
     print(f"📋 Source preference: {' > '.join(source_prefs)}\n")
 
+    tracer.phase("probe sources")
+    extend_path({name: sources.get(name, {}) for name in source_prefs})
+
+    # Probe all sources at once; probes of unchanged toolchains are cached
+    probe_cache_path = state_dir("install-packages") / "sources.json"
+    probe_cache: dict = {} if args.no_cache else read_json(probe_cache_path) or {}
+    probe_snapshot = dict(probe_cache)
+
+    async def probe(src_name: str) -> tuple[str, bool, bool, float]:
+        start = time.perf_counter()
+        with tracer.tags(source=src_name):
+            ok, cached = await check_source_available(sources.get(src_name, {}), probe_cache)
+        return src_name, ok, cached, time.perf_counter() - start
+
+    probes = engine.gather(probe(src_name) for src_name in source_prefs)
+    if probe_cache != probe_snapshot:
+        write_json(probe_cache_path, probe_cache)
+
     available_sources: dict[str, dict] = {}
-    for src_name in source_prefs:
-        src_cfg = sources.get(src_name, {})
-        if check_source_available(src_cfg):
-            available_sources[src_name] = src_cfg
+    for src_name, ok, cached, elapsed in probes:
+        timing = "cached" if cached else f"{elapsed:.2f}s"
+        if ok:
+            available_sources[src_name] = sources.get(src_name, {})
             if args.verbose:
-                print(f"  ✓ {src_name} available")
+                print(f"  ✓ {src_name} available ({timing})")
         else:
             if args.verbose:
-                print(f"  ✗ {src_name} not available")
+                print(f"  ✗ {src_name} not available ({timing})")
 
     if not available_sources:
         print("✗ No package sources available!", file=sys.stderr)
@@ -175,65 +1342,83 @@ def main():
 
     print(f"🔍 Available sources: {', '.join(available_sources.keys())}\n")
 
-    # Set GITHUB_TOKEN for cargo-binstall if available
-    gh_token = get_github_token()
-    if gh_token and "cargo" in available_sources:
-        cargo_cfg = available_sources["cargo"]
-        if "--github-token" not in cargo_cfg.get("install", ""):
-            cargo_cfg["install"] = cargo_cfg["install"].replace(
-                "cargo binstall",
-                f"cargo binstall --github-token={gh_token}",
-            )
-
-    # Pre-cache list outputs for sources that use check_cmd (cargo, uv, dotnet)
-    # This avoids running the same list command per-package
-    source_list_cache: dict[str, str] = {}
-    def get_source_list(src_name: str, src_cfg: dict) -> str:
-        if src_name not in source_list_cache:
-            if "check_cmd" in src_cfg:
-                _, stdout = run_capture(src_cfg["check_cmd"])
-                source_list_cache[src_name] = stdout
-            else:
-                source_list_cache[src_name] = ""
-        return source_list_cache[src_name]
-
-    # Pre-populate caches in parallel
-    list_sources = [s for s in available_sources if "check_cmd" in available_sources[s]]
-    with ThreadPoolExecutor(max_workers=len(list_sources) or 1) as pool:
-        futures = {pool.submit(get_source_list, s, available_sources[s]): s for s in list_sources}
-        for f in as_completed(futures):
-            f.result()
-
-    def check_package_installed_cached(pkg_id: str, src_name: str, src_cfg: dict, pkg_cfg: dict) -> bool:
-        """Check if a package is installed, using cached list output."""
-        if "check_cmd" in src_cfg and "check_grep" in src_cfg:
-            pattern = src_cfg["check_grep"].replace("{pkg}", re.escape(pkg_id))
-            stdout = source_list_cache.get(src_name, "")
-            return bool(re.search(pattern, stdout, re.MULTILINE))
-        return check_package_installed(pkg_id, src_name, src_cfg, pkg_cfg)
-
     # Resolve packages for this profile
     to_install: list[tuple[str, str, str, dict]] = []  # (pkg_name, source_name, pkg_id, pkg_cfg)
     already_installed: list[tuple[str, str]] = []  # (pkg_name, how_detected)
     skipped: list[tuple[str, str]] = []  # (pkg_name, reason)
 
-    # Build list of packages to check
+    profile_packages = {
+        name: cfg for name, cfg in packages.items() if profile_name in cfg.get("profiles", [])
+    }
+
+    if args.upgrade:
+        run_upgrades(args, profile_packages, source_prefs, available_sources)
+        return
+
+    # Only packages whose manifest entries changed since the last applied run
+    # need resolving (skipped with --full or --no-cache, or when limited to one --source)
+    snapshot = ManifestSnapshot(
+        state_dir("install-packages") / f"manifest-{profile_name}-{current_os}.json", source_prefs, sources, profile_packages,
+    )
+    affected = None if args.full or args.no_cache or args.source else snapshot.affected()
+    if affected is not None:
+        print(f"📝 {len(affected)} of {len(profile_packages)} package(s) need checking since last apply (--full to check all)\n")
+
+    # Build list of packages to check, trusting cached entries whose
+    # fingerprint hasn't changed
+    state_cache = InstalledCache(state_dir("install-packages") / "installed.json", enabled=not args.no_cache)
     to_check: list[tuple[str, dict]] = []
-    for pkg_name, pkg_cfg in packages.items():
-        pkg_profiles = pkg_cfg.get("profiles", [])
-        if profile_name not in pkg_profiles:
+    checked: set[str] = set()
+    for pkg_name, pkg_cfg in profile_packages.items():
+        if affected is not None and pkg_name not in affected:
+            already_installed.append((pkg_name, "unchanged since last apply"))
+            continue
+        checked.add(pkg_name)
+        how = state_cache.lookup(pkg_name, pkg_cfg, available_sources)
+        if how:
+            already_installed.append((pkg_name, f"{how} (cached)"))
             continue
         to_check.append((pkg_name, pkg_cfg))
 
-    def resolve_package(pkg_name: str, pkg_cfg: dict) -> tuple[str, str, str | None, str | None, dict]:
+    tracer.phase("fetch inventories")
+    # Fetch each source's inventory (check_cmd) once, all sources in parallel,
+    # and parse it into a {package_id: version} index per source. Only sources
+    # used by packages that weren't answered from the cache are fetched.
+    # A failed inventory is recorded as None and falls back to `check`.
+    source_list_cache: dict[str, dict[str, str | None] | None] = {}
+    async def get_source_list(src_name: str, src_cfg: dict) -> None:
+        with tracer.tags(source=src_name):
+            rc, stdout, timed_out = await engine.run(src_cfg["check_cmd"], source_timeout(src_cfg, "check"))
+        if rc != 0:
+            source_list_cache[src_name] = None
+            if timed_out:
+                print(f"  ⚠ {src_name} inventory timed out, checking per package")
+            elif args.verbose:
+                print(f"  ⚠ {src_name} inventory failed (exit {rc}), checking per package")
+            return
+        source_list_cache[src_name] = parse_inventory(stdout, src_cfg.get("check_parse", {}))
+        if source_list_cache[src_name] is None and args.verbose:
+            print(f"  ⚠ {src_name} inventory couldn't be parsed, checking per package")
+
+    needed_sources = {src for _, cfg in to_check for src in cfg.get("sources", {})}
+    list_sources = [
+        s for s in available_sources if s in needed_sources and "check_cmd" in available_sources[s]
+    ]
+    engine.gather(get_source_list(s, available_sources[s]) for s in list_sources)
+
+
+    async def resolve_package(pkg_name: str, pkg_cfg: dict) -> tuple[str, str, str | None, str | None, dict]:
         """Resolve a single package. Returns (pkg_name, status, src_name, pkg_id, pkg_cfg).
         status is 'installed', 'to_install', or 'skipped'."""
         pkg_sources = pkg_cfg.get("sources", {})
 
         # First: check if the binary is already in PATH
         binary = pkg_cfg.get("binary", pkg_name)
-        if shutil.which(binary):
-            return (pkg_name, "installed", f"binary '{binary}' in PATH", None, pkg_cfg)
+        binary_path = path_index.which(binary)
+        if binary_path:
+            how = f"binary '{binary}' in PATH"
+            state_cache.record_binary(pkg_name, binary, binary_path, how)
+            return (pkg_name, "installed", how, None, pkg_cfg)
 
         # Second: check each source's own detection method
         for src_name in source_prefs:
@@ -243,8 +1428,14 @@ def main():
                 continue
             pkg_id = pkg_sources[src_name]
             src_cfg = available_sources[src_name]
-            if check_package_installed_cached(pkg_id, src_name, src_cfg, pkg_cfg):
-                return (pkg_name, "installed", f"detected via {src_name}", None, pkg_cfg)
+            inventory = source_list_cache.get(src_name)
+            with tracer.tags(source=src_name, package=pkg_name):
+                installed = await check_package_installed(pkg_id, src_name, src_cfg, pkg_cfg, inventory)
+            if installed:
+                version = inventory.get(inventory_key(pkg_id, src_cfg.get("check_parse", {}))) if inventory else None
+                how = f"detected via {src_name}" + (f" ({version})" if version else "")
+                state_cache.record_source(pkg_name, src_name, src_cfg, pkg_id, how)
+                return (pkg_name, "installed", how, None, pkg_cfg)
 
         # Third: find the preferred source to install from
         for src_name in source_prefs:
@@ -261,17 +1452,37 @@ def main():
             return (pkg_name, "skipped", "no available source", None, pkg_cfg)
         return (pkg_name, "skipped", "not in source preference", None, pkg_cfg)
 
-    # Run checks in parallel
-    with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as pool:
-        futures = {pool.submit(resolve_package, name, cfg): name for name, cfg in to_check}
-        for future in as_completed(futures):
-            pkg_name, status, info, pkg_id, pkg_cfg = future.result()
-            if status == "installed":
-                already_installed.append((pkg_name, info))
-            elif status == "to_install":
-                to_install.append((pkg_name, info, pkg_id, pkg_cfg))
-            else:
-                skipped.append((pkg_name, info))
+    tracer.phase("resolve")
+    # Resolve every package at once; the engine bounds concurrent checks
+    for pkg_name, status, info, pkg_id, pkg_cfg in engine.gather(
+        resolve_package(name, cfg) for name, cfg in to_check
+    ):
+        if status == "installed":
+            already_installed.append((pkg_name, info))
+        elif status == "to_install":
+            to_install.append((pkg_name, info, pkg_id, pkg_cfg))
+        else:
+            skipped.append((pkg_name, info))
+
+    # Packages with no available source may be waiting on a package in this
+    # run that provides one (e.g. rustup provides cargo); follow `provides`
+    # transitively so waiting packages can be providers too
+    waiting: dict[str, dict] = {}
+    providable = {src for _, _, _, cfg in to_install for src in cfg.get("provides", [])}
+    unresolved = {name: packages[name] for name, reason in skipped if reason == "no available source"}
+    while True:
+        newly = {
+            name: cfg for name, cfg in unresolved.items()
+            if name not in waiting and providable & set(cfg.get("sources", {})) & set(source_prefs)
+        }
+        if not newly:
+            break
+        waiting.update(newly)
+        providable |= {src for cfg in newly.values() for src in cfg.get("provides", [])}
+    skipped = [(name, reason) for name, reason in skipped if name not in waiting]
+
+    tracer.phase("summary")
+    state_cache.save(checked)
 
     # Summary
     print(f"✓ Already installed: {len(already_installed)}")
@@ -287,13 +1498,25 @@ def main():
             print(f"  [{src_name}]")
             for pkg_name, pkg_id in pkgs:
                 print(f"    {pkg_name} ({pkg_id})")
+    if waiting:
+        print(f"⏳ Waiting on a source installed in this run: {len(waiting)}")
+        for name, cfg in waiting.items():
+            needs = sorted(providable & set(cfg.get("sources", {})))
+            print(f"    {name}: needs {' or '.join(needs)}")
     if skipped:
         print(f"⚠ Skipped: {len(skipped)}")
         for name, reason in skipped:
             print(f"    {name}: {reason}")
     print()
 
+    def save_snapshot(failed: set[str]):
+        if not args.dry_run and not args.source:
+            installed = {name for name, _ in already_installed}
+            installed |= {name for name, _, _, _ in to_install if name not in failed}
+            snapshot.save(installed)
+
     if not to_install:
+        save_snapshot(set())
         print("✅ Everything is installed!")
         return
 
@@ -301,27 +1524,103 @@ def main():
         return
 
     # Group by source for installation
-    by_source: dict[str, list[tuple[str, str, dict]]] = {}
+    by_source: dict[str, list[tuple[str, str]]] = {}
     for pkg_name, src_name, pkg_id, pkg_cfg in to_install:
-        by_source.setdefault(src_name, []).append((pkg_name, pkg_id, pkg_cfg))
+        by_source.setdefault(src_name, []).append((pkg_name, pkg_id))
 
-    # Install
-    failures: list[tuple[str, str]] = []
-    for src_name, pkgs in by_source.items():
+    tracer.phase("install")
+    failures: list[tuple[str, str, str]] = []  # (pkg_name, source_name, status)
+    prime_sudo([available_sources[src_name] for src_name in by_source])
+    scheduler = InstallScheduler(args.jobs, make_console(args), args.prefetch_jobs)
+    if not args.no_prefetch:
+        # Start downloads for everything before the first install finishes
+        for src_name, pkgs in by_source.items():
+            scheduler.prefetch(src_name, available_sources[src_name], [pkg_id for _, pkg_id in pkgs])
+
+    def submit(src_name: str, pkgs: list[tuple[str, str]]) -> Future:
         src_cfg = available_sources[src_name]
-        print(f"📦 Installing from {src_name} ({len(pkgs)} packages):\n")
-        for pkg_name, pkg_id, pkg_cfg in pkgs:
-            print(f"  [{pkg_name}] via {src_name}:")
-            if not install_package(pkg_id, src_name, src_cfg):
-                failures.append((pkg_name, src_name))
-                print(f"    ✗ Failed\n")
+        apply_github_token(src_cfg)
+        return scheduler.submit(src_name, src_cfg, pkgs)
+
+    def release_dependents(installed: list[str]) -> dict[str, list[tuple[str, str]]]:
+        """Re-probe sources provided by just-installed packages and resolve
+        the packages that were waiting on them. Returns new install jobs."""
+        provided = {
+            src for name in installed for src in packages[name].get("provides", [])
+            if src in source_prefs and src not in available_sources
+        }
+        if not provided or not waiting:
+            return {}
+        extend_path({src: sources[src] for src in provided})
+        path_index.invalidate()
+        for src in sorted(provided):
+            with tracer.tags(source=src):
+                ok, _ = engine.call(check_source_available(sources[src]))
+            if not ok:
+                scheduler.console.emit(f"⚠ {src} is still unavailable after installing its provider\n")
+                continue
+            scheduler.console.emit(f"🔓 {src} is now available\n")
+            available_sources[src] = sources[src]
+            if "check_cmd" in sources[src]:
+                engine.call(get_source_list(src, sources[src]))
+
+        jobs: dict[str, list[tuple[str, str]]] = {}
+        ready = [
+            (pkg_name, pkg_cfg) for pkg_name, pkg_cfg in waiting.items()
+            if set(pkg_cfg.get("sources", {})) & set(available_sources)
+        ]
+        for pkg_name, status, info, pkg_id, pkg_cfg in engine.gather(
+            resolve_package(pkg_name, pkg_cfg) for pkg_name, pkg_cfg in ready
+        ):
+            del waiting[pkg_name]
+            if status == "installed":
+                already_installed.append((pkg_name, info))
+            elif status == "to_install":
+                to_install.append((pkg_name, info, pkg_id, pkg_cfg))
+                jobs.setdefault(info, []).append((pkg_name, pkg_id))
             else:
-                print(f"    ✓ Done\n")
+                skipped.append((pkg_name, info))
+        return jobs
+
+    # Install, overlapping independent sources. Finishing a job can release
+    # packages that were waiting on a source it provided, which are queued
+    # straight away.
+    pending = {submit(src_name, pkgs): src_name for src_name, pkgs in by_source.items()}
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            src_name = pending.pop(future)
+            installed = []
+            for pkg_name, status in future.result():
+                if status == "ok":
+                    installed.append(pkg_name)
+                else:
+                    failures.append((pkg_name, src_name, status))
+            for next_src, pkgs in release_dependents(installed).items():
+                pending[submit(next_src, pkgs)] = next_src
+    scheduler.shutdown()
+    if waiting:
+        stuck = [
+            (name, f"{' or '.join(sorted(providable & set(cfg.get('sources', {}))))} did not become available")
+            for name, cfg in waiting.items()
+        ]
+        skipped.extend(stuck)
+        print(f"⚠ Skipped: {len(stuck)}")
+        for name, reason in stuck:
+            print(f"    {name}: {reason}")
+
+    tracer.phase("verify")
+    # Installs may have added executables; rescan PATH before checking them
+    path_index.invalidate()
+    failed_names = {pkg_name for pkg_name, _, _ in failures}
+    save_snapshot(failed_names)
+    for pkg_name, src_name, _, pkg_cfg in to_install:
+        binary = pkg_cfg.get("binary")
+        if binary and pkg_name not in failed_names and not path_index.which(binary):
+            print(f"⚠ {pkg_name} installed via {src_name} but '{binary}' is not on PATH yet")
 
     if failures:
-        print(f"\n⚠ {len(failures)} package(s) failed to install:")
-        for pkg_name, src_name in failures:
-            print(f"    {pkg_name} ({src_name})")
+        print_failures(failures, "install", scheduler.console.log_dir)
         sys.exit(1)
     else:
         print("\n✅ All packages installed!")
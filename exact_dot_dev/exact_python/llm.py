@@ -0,0 +1,161 @@
+"""Run prompts through an LLM command line, with an on-disk response cache.
+
+Shared by step.py (commit messages) and gn.py (branch names). Responses are
+stored under the state dir, keyed by a hash of the backend command and the
+prompt, so re-running after an aborted commit doesn't pay the LLM latency
+again; the cache is kept under CACHE_MAX_BYTES by evicting the least
+recently used entries.
+
+Configuration, all through the environment:
+  DEV_LLM_COMMAND  backend command line (prompt on stdin, reply on stdout);
+                   "stub" or "stub:TEXT" answers locally, for offline tests
+  DEV_LLM_TIMEOUT  seconds to wait for the backend (default 60)
+  DEV_LLM_CACHE    set to 0 to bypass the cache
+"""
+
+import hashlib
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+from pathlib import Path
+
+from statedir import state_dir
+
+DEFAULT_COMMAND = "copilot --silent --allow-all-tools --model gpt-4.1"
+DEFAULT_TIMEOUT = 60  # seconds
+CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+
+def get_cache_dir() -> Path:
+    """Return the per-user directory where responses are cached."""
+    return state_dir("llm") / "cache"
+
+
+def get_command() -> str:
+    return os.environ.get("DEV_LLM_COMMAND", "").strip() or DEFAULT_COMMAND
+
+
+def cache_key(command: str, prompt: str) -> str:
+    return hashlib.sha256(f"{command}\0{prompt}".encode()).hexdigest()
+
+
+def cache_get(key: str) -> str | None:
+    """Return a cached response, marking it as recently used."""
+    path = get_cache_dir() / f"{key}.txt"
+    try:
+        text = path.read_text(encoding="utf-8")
+        os.utime(path)
+    except OSError:
+        return None
+    return text or None
+
+
+def cache_put(key: str, text: str):
+    """Atomically store a response, then evict the oldest entries over the size limit."""
+    cache_dir = get_cache_dir()
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = cache_dir / f"{key}.{os.getpid()}.tmp"
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, cache_dir / f"{key}.txt")
+
+        entries = []
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith(".txt"):
+                st = entry.stat()
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= CACHE_MAX_BYTES:
+                break
+            os.unlink(path)
+            total -= size
+    except OSError:
+        pass
+
+
+def run_backend(command: str, prompt: str, timeout: float) -> str | None:
+    """Send the prompt to the backend command; None if it's missing, fails or times out."""
+    if command == "stub" or command.startswith("stub:"):
+        return command[len("stub:"):] or f"stub-{cache_key(command, prompt)[:8]}"
+
+    argv = shlex.split(command, posix=sys.platform != "win32")
+    exe = shutil.which(argv[0]) if argv else None
+    if not exe:
+        return None
+    # Own process group, so a timeout can kill whatever the backend spawned
+    # (copilot.cmd runs node) rather than leave it holding our pipes open
+    kwargs = {}
+    if sys.platform == "win32":
+        kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    try:
+        proc = subprocess.Popen(
+            [exe, *argv[1:]], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            text=True, errors="replace", **kwargs,
+        )
+    except OSError:
+        return None
+    try:
+        stdout, _ = proc.communicate(prompt, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_tree(proc)
+        print(f"⏱️  {argv[0]} timed out after {timeout:g}s", file=sys.stderr)
+        return None
+    if proc.returncode != 0:
+        return None
+    return stdout.strip() or None
+
+
+def kill_process_tree(proc: subprocess.Popen):
+    """Kill a backend started in its own process group, with everything it spawned."""
+    if sys.platform == "win32":
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(proc.pid)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    try:
+        proc.kill()
+    except OSError:
+        pass
+    for pipe in (proc.stdin, proc.stdout, proc.stderr):
+        try:
+            pipe.close()
+        except OSError:
+            pass
+    proc.wait()
+
+
+def complete(prompt: str, timeout: float | None = None) -> str | None:
+    """Return the backend's response to `prompt`, from the cache when possible.
+
+    Returns None when no response could be produced, leaving the fallback
+    to the caller.
+    """
+    command = get_command()
+    if timeout is None:
+        try:
+            timeout = float(os.environ.get("DEV_LLM_TIMEOUT", DEFAULT_TIMEOUT))
+        except ValueError:
+            timeout = DEFAULT_TIMEOUT
+    use_cache = os.environ.get("DEV_LLM_CACHE", "1") != "0"
+
+    key = cache_key(command, prompt)
+    if use_cache:
+        cached = cache_get(key)
+        if cached:
+            return cached
+
+    text = run_backend(command, prompt, timeout)
+    if text and use_cache:
+        cache_put(key, text)
+    return text
@@ -0,0 +1,58 @@
+"""Per-user state files and detached helpers shared by the scripts in this directory.
+
+gg.py, step.py, llm.py and the install-packages scripts import it as a
+sibling module; each keeps its files in its own subdirectory of the state dir.
+"""
+
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+
+def state_dir(tool: str) -> Path:
+    """Return the per-user directory where `tool` keeps its state."""
+    if sys.platform == "win32":
+        base = Path(os.environ.get("LOCALAPPDATA", Path.home() / "AppData" / "Local"))
+    else:
+        base = Path(os.environ.get("XDG_STATE_HOME", Path.home() / ".local" / "state"))
+    return base / tool
+
+
+def read_json(path: Path):
+    """Load a JSON state file, or return None if it is missing or corrupt."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path: Path, data) -> bool:
+    """Atomically write a JSON state file; returns False if that failed."""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+        return True
+    except (OSError, TypeError):
+        return False
+
+
+def spawn_detached(args: list[str]) -> bool:
+    """Start a background process that outlives this one; returns False if it couldn't start."""
+    kwargs = {}
+    if sys.platform == "win32":
+        kwargs["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    try:
+        subprocess.Popen(
+            args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs,
+        )
+        return True
+    except OSError:
+        return False
@@ -3,11 +3,27 @@
 # requires-python = ">=3.11"
 # dependencies = []
 # ///
-"""AI-powered git commit: stage all changes, generate commit message, commit and push."""
+"""AI-powered git commit: stage all changes, generate commit message, commit and push.
 
-import shutil
+With --async-push the push is handed to a detached worker and step returns as
+soon as the commit lands. Jobs are queued under the state dir, one file per
+repo and branch, so repeated pushes of a branch merge into one; failed pushes
+are retried with backoff and every outcome goes to a log shown by --push-log.
+"""
+
+import argparse
+import hashlib
+import json
+import os
 import subprocess
 import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+from diffprompt import build_diff_prompt
+from llm import complete
+from statedir import read_json, spawn_detached, state_dir, write_json
 
 
 def run(*args, **kwargs):
@@ -15,7 +31,249 @@ def run(*args, **kwargs):
     return subprocess.run(args, capture_output=True, text=True, **kwargs)
 
 
+PUSH_ATTEMPTS = 5
+PUSH_BACKOFF = 10  # seconds before the first retry, tripled after each failure
+PUSH_TIMEOUT = 600  # seconds
+LOG_MAX_BYTES = 256 * 1024
+
+
+def log_push(job, status, attempt=0, output="", **extra):
+    """Append an entry to the push log (one JSON object per line)."""
+    entry = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "repo": job["repo"], "branch": job["branch"], "status": status, "attempt": attempt,
+        "output": output[-2000:], **extra,
+    }
+    try:
+        with open(state_dir("step") / "push.log", "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError:
+        pass
+
+
+def trim_log():
+    """Keep the newest half of the push log once it outgrows LOG_MAX_BYTES."""
+    path = state_dir("step") / "push.log"
+    try:
+        if path.stat().st_size <= LOG_MAX_BYTES:
+            return
+        lines = path.read_text(encoding="utf-8").splitlines(keepends=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text("".join(lines[len(lines) // 2:]), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def push_remote(branch):
+    """Return the remote a plain `git push` of `branch` would go to."""
+    for key in (f"branch.{branch}.pushRemote", "remote.pushDefault", f"branch.{branch}.remote"):
+        remote = run("git", "config", "--get", key).stdout.strip()
+        if remote:
+            return remote
+    return "origin"
+
+
+def queue_push(repo, branch) -> bool:
+    """Queue a push of `branch` and make sure a worker is running; False if it couldn't be queued.
+
+    The remote and ref are resolved now so a later branch switch can't
+    redirect the push. A branch without an upstream is pushed with
+    --set-upstream, as a plain `git push` does with push.autoSetupRemote.
+    """
+    ref = f"refs/heads/{branch}"
+    upstream, remote_ref = (run(
+        "git", "for-each-ref", "--format=%(upstream)%09%(push:remoteref)", ref,
+    ).stdout.rstrip("\n").split("\t") + [""])[:2]
+    job = {
+        "repo": repo, "branch": branch, "remote": push_remote(branch),
+        "refspec": f"{ref}:{remote_ref}" if remote_ref else ref, "set_upstream": not upstream,
+        "attempt": 0, "not_before": 0,
+    }
+    key = hashlib.sha1(f"{repo}\0{branch}".encode()).hexdigest()[:16]
+    path = state_dir("step") / "queue" / f"{key}.json"
+    merged = path.exists()
+    if not write_json(path, job):
+        return False
+    log_push(job, "merged" if merged else "queued")
+    return spawn_detached([sys.executable, __file__, "--push-worker"])
+
+
+def try_lock(f) -> bool:
+    """Take a non-blocking exclusive lock on an open file (released on close)."""
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def push_job(job, path):
+    """Run one queued push; on failure requeue it with backoff unless a newer push replaced it."""
+    attempt = job["attempt"] + 1
+    try:
+        result = subprocess.run(
+            ["git", "-C", job["repo"], "push", *(["--set-upstream"] if job.get("set_upstream") else []),
+             job["remote"], job["refspec"]],
+            stdin=subprocess.DEVNULL, capture_output=True, text=True, errors="replace",
+            timeout=PUSH_TIMEOUT, env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
+        )
+        ok, output = result.returncode == 0, (result.stdout + result.stderr).strip()
+    except subprocess.TimeoutExpired:
+        ok, output = False, f"timed out after {PUSH_TIMEOUT}s"
+    except OSError as e:
+        ok, output = False, str(e)
+
+    if ok:
+        log_push(job, "ok", attempt, output)
+    elif attempt >= PUSH_ATTEMPTS:
+        log_push(job, "failed", attempt, output)
+    else:
+        delay = PUSH_BACKOFF * 3 ** (attempt - 1)
+        log_push(job, "retry", attempt, output, delay=delay)
+        if not path.exists():
+            write_json(path, {**job, "attempt": attempt, "not_before": time.time() + delay})
+
+
+def drain_queue(queue: Path):
+    """Push queued jobs as they come due until the queue is empty."""
+    while True:
+        jobs = []
+        for path in queue.glob("*.json"):
+            job = read_json(path)
+            if job:
+                jobs.append((job, path))
+            else:
+                path.unlink(missing_ok=True)
+        if not jobs:
+            return
+        now = time.time()
+        ready = [(job, path) for job, path in jobs if job["not_before"] <= now]
+        if not ready:
+            # Poll rather than sleep through the backoff, so new jobs aren't held up
+            time.sleep(min(1.0, min(job["not_before"] for job, _ in jobs) - now))
+            continue
+        for job, path in ready:
+            # Claim the job by renaming it; a push queued from now on lands in a
+            # new file and runs after this one, covering any commits it missed.
+            active = path.with_suffix(".active")
+            try:
+                os.replace(path, active)
+            except OSError:
+                continue
+            push_job(read_json(active) or job, path)
+            active.unlink(missing_ok=True)
+
+
+def requeue_stale(queue: Path):
+    """Put back pushes claimed by a worker that died mid-push.
+
+    Only called with the worker lock held, so no live worker owns any
+    .active file. If the branch has been queued again since, that job
+    already covers it.
+    """
+    for active in queue.glob("*.active"):
+        job = read_json(active)
+        pending = active.with_suffix(".json")
+        if job and not pending.exists():
+            if not write_json(pending, {**job, "not_before": 0}):
+                continue
+            log_push(job, "requeued", job["attempt"], "worker stopped before the push finished")
+        active.unlink(missing_ok=True)
+
+
+def worker_running() -> bool:
+    """Whether a push worker currently holds the lock."""
+    try:
+        with open(state_dir("step") / "worker.lock", "a+") as lock:
+            return not try_lock(lock)
+    except OSError:
+        return False
+
+
+def push_worker():
+    """Drain the push queue, unless another worker already holds the lock."""
+    step_dir = state_dir("step")
+    queue = step_dir / "queue"
+    queue.mkdir(parents=True, exist_ok=True)
+    while True:
+        with open(step_dir / "worker.lock", "a+") as lock:
+            if not try_lock(lock):
+                return
+            requeue_stale(queue)
+            drain_queue(queue)
+            trim_log()
+        # A job queued while the lock was being released found it held and
+        # didn't start a worker, so look once more after letting go.
+        if not any(queue.glob("*.json")):
+            return
+
+
+def show_push_log(count):
+    """Print pending pushes and the last `count` log entries."""
+    now = time.time()
+    queue = state_dir("step") / "queue"
+    pending = sorted(queue.glob("*.json")) + sorted(queue.glob("*.active"))
+    running = worker_running()
+    if pending and not running:
+        # The last worker died; a new one requeues its interrupted push
+        spawn_detached([sys.executable, __file__, "--push-worker"])
+    for path in pending:
+        job = read_json(path)
+        if not job:
+            continue
+        if path.suffix == ".active":
+            state = "pushing" if running else "interrupted, retrying"
+        elif job["not_before"] > now:
+            state = f"retry in {job['not_before'] - now:.0f}s"
+        else:
+            state = "pending"
+        print(f"⏳ {job['repo']} {job['branch']} ({state})")
+
+    try:
+        lines = (state_dir("step") / "push.log").read_text(encoding="utf-8").splitlines()
+    except OSError:
+        lines = []
+    icons = {"ok": "✅", "failed": "❌", "retry": "🔁", "requeued": "🔁", "queued": "📤", "merged": "📤"}
+    for line in lines[-count:] if count > 0 else []:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        status = entry["status"]
+        detail = f" attempt {entry['attempt']}" if entry["attempt"] else ""
+        if status == "retry":
+            detail += f", next in {entry.get('delay', 0)}s"
+        elif status == "merged":
+            detail = " into a pending push"
+        print(f"{icons.get(status, '•')} {entry['time']} {entry['repo']} {entry['branch']}: {status}{detail}")
+        if status in ("failed", "retry") and entry["output"]:
+            for output_line in entry["output"].splitlines()[-3:]:
+                print(f"     {output_line}")
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Stage all changes, commit with a generated message and push")
+    parser.add_argument("--async-push", action="store_true", help="Push in the background and return after the commit")
+    parser.add_argument(
+        "--push-log", nargs="?", type=int, const=20, metavar="N",
+        help="Show pending background pushes and the last N results (default 20)",
+    )
+    parser.add_argument("--push-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.push_worker:
+        push_worker()
+        return
+    if args.push_log is not None:
+        show_push_log(args.push_log)
+        return
+
     # Capture untracked files before staging
     untracked = run("git", "ls-files", "--others", "--exclude-standard")
     untracked_files = [f for f in untracked.stdout.strip().split("\n") if f]
@@ -28,37 +286,20 @@ def main():
         print("No changes to commit")
         sys.exit(1)
 
-    # Get branch name and diff
+    # Get branch name and diff. Newly tracked files are already in the cached
+    # diff, so their content isn't added separately.
     branch = run("git", "rev-parse", "--abbrev-ref", "HEAD").stdout.strip() or "unknown"
-    diff = run("git", "diff", "--cached", "HEAD").stdout
-
-    # Get content of newly tracked files
-    untracked_content = ""
-    for f in untracked_files:
-        result = run("git", "show", f":0:{f}")
-        if result.returncode == 0:
-            untracked_content += f"\nNew file: {f}\n{result.stdout}"
+    diff = run("git", "diff", "--cached", "HEAD", errors="replace").stdout
 
     prompt = (
         f"Read the following changes. The current branch is '{branch}'. "
         "Generate a concise commit message following conventional commit format. "
         "Output ONLY the commit message, nothing else.\n\n"
-        f"{diff}"
+        f"{build_diff_prompt(diff, untracked=untracked_files)}"
     )
-    if untracked_content:
-        prompt += f"\n{untracked_content}"
-
-    # Generate commit message with copilot
-    copilot = shutil.which("copilot")
-    commit_msg = None
-    if copilot:
-        result = run(
-            copilot, "--silent", "--allow-all-tools", "--model", "gpt-4.1",
-            input=prompt,
-        )
-        if result.returncode == 0 and result.stdout.strip():
-            commit_msg = result.stdout.strip()
 
+    # Generate commit message (cached per prompt, see llm.py)
+    commit_msg = complete(prompt)
     if not commit_msg:
         print("Failed to generate commit message", file=sys.stderr)
         sys.exit(1)
@@ -70,6 +311,13 @@ def main():
         sys.exit(1)
     print(result.stdout, end="")
 
+    if args.async_push and branch != "HEAD":
+        repo = run("git", "rev-parse", "--show-toplevel").stdout.strip()
+        if queue_push(repo, branch):
+            print(f"Push of {branch} queued (step --push-log to follow it)")
+            return
+        print("Could not queue push, pushing now", file=sys.stderr)
+
     result = run("git", "push")
     print(result.stdout, end="")
     print(result.stderr, end="")